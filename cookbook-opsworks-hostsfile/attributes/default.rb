@@ -13,7 +13,22 @@
 # permissions and limitations under the License.
 #
 
+# 'cron' runs the script periodically, 'service' keeps it running in watch mode
+default['opsworks_hostsfile']['mode'] = 'cron'
 default['opsworks_hostsfile']['cron_frequency'] = '*/15'
+default['opsworks_hostsfile']['watch_interval'] = 60
+default['opsworks_hostsfile']['status_file'] = '/var/run/opsworks-hosts.json'
+
+# OpsWorks regions to fetch stacks from, and where the stack list of each region is cached between runs
+default['opsworks_hostsfile']['regions'] = ['us-east-1']
+default['opsworks_hostsfile']['stack_cache_file'] = '/var/tmp/opsworks-hosts-stacks.json'
+
+# Shared directory (e.g. an EFS/NFS mount) used to share one snapshot of the hosts between all nodes
+default['opsworks_hostsfile']['snapshot_dir'] = nil
+# 'auto' elects one publisher, 'publish' always calls the API, 'consume' only reads the snapshot
+default['opsworks_hostsfile']['snapshot_role'] = 'auto'
+# Seconds the publisher holds its lease, nil derives it from the cron frequency or the watch interval
+default['opsworks_hostsfile']['snapshot_lease'] = nil
 default['opsworks_hostsfile']['script_location'] = '/root/hosts.py'
 
 default['opsworks_hostsfile']['user'] = 'root'
@@ -15,62 +15,538 @@
 # permissions and limitations under the License.
 #
 
+import hashlib
+import json
+import logging
+import optparse
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
 import botocore.session
+from botocore.exceptions import BotoCoreError, ClientError
+
 
+HOSTS_FILE = '/etc/hosts'
+HOSTS_DELIMITER = "### All Hosts ###"
+MAX_WORKERS = 8
+SNAPSHOT_FILE = 'hosts-snapshot.json'
+PUBLISHER_LEASE_FILE = 'publisher.lease'
+DEFAULT_REGIONS = ['us-east-1']
+
+logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
+log = logging.getLogger('opsworks-hosts')
 
 session = botocore.session.get_session()
-service = session.get_service('opsworks')
-endpoint = service.get_endpoint('us-east-1')
+clients = {}
+clients_lock = threading.Lock()
+
+
+class ApiCallError(Exception):
+  pass
+
+
+class StackNotFoundError(ApiCallError):
+  pass
+
+
+class SnapshotError(Exception):
+  pass
+
+
+def get_client(region):
+  """
+  :return: the OpsWorks client of the region, created once and shared by all threads
+  """
+  with clients_lock:
+    if region not in clients:
+      clients[region] = session.create_client('opsworks', region_name=region)
+    return clients[region]
 
 
-def _make_api_call(api_operation, **kwargs):
+def _make_api_call(region, api_operation, **kwargs):
   """
   Make an API call using botocore for the given api operation.
-  :param api_operation: Operation name to perform
+  :param region: OpsWorks region endpoint to call
+  :param api_operation: Operation name to perform, e.g. describe_instances
   :param kwargs: Any additional arguments to be passed to the service call
-  :return: If an OK response returned, returns the data from the call.  Will exit(1) otherwise
+  :return: the data from the call.  Raises ApiCallError (StackNotFoundError for unknown stacks) otherwise
   """
-  operation = service.get_operation(api_operation)
-  response, response_data = operation.call(endpoint, **kwargs)
-  if response.ok:
-    return response_data
+  try:
+    return getattr(get_client(region), api_operation)(**kwargs)
+  except ClientError as e:
+    if e.response.get('Error', {}).get('Code') == 'ResourceNotFoundException':
+      raise StackNotFoundError("Error occurred calling {0} in {1} - {2}".format(api_operation, region, e))
+    raise ApiCallError("Error occurred calling {0} in {1} - {2}".format(api_operation, region, e))
+  except BotoCoreError as e:
+    raise ApiCallError("Error occurred calling {0} in {1} - {2}".format(api_operation, region, e))
 
-  click.echo("Error occurred calling {0} - {1} - Status {2} Message {3}".format(response.url,
-                                                                                api_operation,
-                                                                                response.status_code,
-                                                                                response.text))
-  sys.exit(1)
 
+def get_stack_hosts(region, stack):
+  """
+  Get the private IP of every instance in a stack.
+  :param stack: tuple of (stack name, stack id)
+  :return: tuple of (stack name, dict of hostname -> private ip)
+  """
+  stack_name, stack_id = stack
+  stack_hosts = {}
+  instances = _make_api_call(region, 'describe_instances', StackId=stack_id)['Instances']
+  for each in instances:
+    if 'PrivateIp' in each:
+      stack_hosts[each['Hostname']] = each['PrivateIp']
+  return stack_name, stack_hosts
 
-if __name__ == '__main__':
-  hosts_delimeter = "### All Hosts ###"
-  custom_hosts = [hosts_delimeter]
-
-  stack_map = {}
-  stacks = _make_api_call('DescribeStacks')['Stacks']
-  for each in stacks:
-    stack_id = each['StackId']
-    stack_name = each['Name']
-    stack_map[stack_name] = stack_id
-
-  for stack_name,stack_id in stack_map.iteritems():
-    instances = _make_api_call('DescribeInstances', stack_id=stack_id)['Instances']
-    for each in instances:
-      host_name = each['Hostname']
-      if 'PrivateIp' in each:
-        custom_hosts.append("{0} {1}-{2}".format(each['PrivateIp'], stack_name, host_name))
-
-  opsworks_hosts = []
-  with open('/etc/hosts', 'r') as host_file:
+
+def list_stacks(region):
+  """
+  :return: sorted list of [stack name, stack id] in the region
+  """
+  stacks = _make_api_call(region, 'describe_stacks')['Stacks']
+  return sorted([[each['Name'], each['StackId']] for each in stacks])
+
+
+def fetch_region_stacks(region, stack_list):
+  """
+  Fetch the instances of every stack of a region concurrently.
+  :return: dict of stack name -> dict of hostname -> private ip
+  """
+  if not stack_list:
+    return {}
+
+  pool = ThreadPool(min(MAX_WORKERS, len(stack_list)))
+  try:
+    return dict(pool.map(lambda stack: get_stack_hosts(region, stack), stack_list))
+  finally:
+    pool.close()
+    pool.join()
+
+
+class RegionFetcher(object):
+  """
+  Fetches the instances of all stacks in several OpsWorks regions concurrently, each region with
+  its own pool of threads.
+
+  The stack list of each region is kept for stack_ttl seconds (in cache_file, if given, so it also
+  survives between cron runs), which leaves a region with unchanged stacks one DescribeInstances
+  call per stack.  The last hosts fetched from each region are kept as well: a region that fails,
+  or has not answered within region_timeout seconds, contributes its last known hosts instead of
+  holding up or failing the refresh of the other regions.  A region still running late is not
+  started again; its result is picked up by the next refresh.
+  """
+  def __init__(self, regions, cache_file=None, stack_ttl=900, region_timeout=30):
+    self.regions = regions
+    self.cache_file = cache_file
+    self.stack_ttl = stack_ttl
+    self.region_timeout = region_timeout
+    self.region_status = {}
+
+    cache = read_json(cache_file) if cache_file is not None else None
+    self.cache = cache if isinstance(cache, dict) else {}
+    self._lock = threading.Lock()
+    self._in_flight = {}
+    self._pool = None
+
+  def fetch(self):
+    """
+    :return: dict of stack name -> dict of hostname -> private ip, merged across regions.  A stack
+             name used in several regions is taken from the first of them in self.regions.
+    """
+    if self._pool is None:
+      self._pool = ThreadPool(len(self.regions))
+    for region in self.regions:
+      if region not in self._in_flight:
+        self._in_flight[region] = (time.time(), self._pool.apply_async(self._fetch_region, (region,)))
+
+    deadline = time.time() + self.region_timeout
+    stack_map = {}
+    for region in self.regions:
+      region_map = self._wait_for_region(region, deadline)
+      for stack_name in sorted(region_map):
+        if stack_name in stack_map:
+          log.warning("Stack %s exists in several regions, ignoring the one in %s", stack_name, region)
+        else:
+          stack_map[stack_name] = region_map[stack_name]
+
+    self._save_cache()
+    return stack_map
+
+  def _wait_for_region(self, region, deadline):
+    """
+    :return: the hosts of the region, or its last known hosts if it failed or is late
+    """
+    start_time, result = self._in_flight[region]
+    with self._lock:
+      cached = self.cache.get(region, {}).get('stack_map')
+    try:
+      # without last known hosts there is nothing to fall back to, so wait for the region
+      region_map = result.get(max(0, deadline - time.time()) if cached is not None else None)
+    except TimeoutError:
+      self.region_status.setdefault(region, {}).update(error="Still running after {0:.0f} seconds".format(time.time() - start_time), stale=True)
+      log.warning("Region %s has not answered within %d seconds, using its last known hosts", region, self.region_timeout)
+      return cached
+    except Exception as e:
+      del self._in_flight[region]
+      self.region_status.setdefault(region, {}).update(error=str(e), stale=cached is not None, latency_seconds=round(time.time() - start_time, 3))
+      if cached is None:
+        raise ApiCallError("Fetching region {0} failed and no hosts are known for it: {1}".format(region, e))
+      log.error("Fetching region %s failed, using its last known hosts: %s", region, e)
+      return cached
+
+    del self._in_flight[region]
+    self.region_status[region].update(error=None, stale=False, latency_seconds=round(time.time() - start_time, 3))
+    return region_map
+
+  def _fetch_region(self, region):
+    start_time = time.time()
+    stack_list, cached = self._stack_list(region)
+    try:
+      region_map = fetch_region_stacks(region, stack_list)
+    except StackNotFoundError:
+      if not cached:
+        raise
+      log.info("A cached stack in %s no longer exists, listing its stacks again", region)
+      stack_list, cached = self._stack_list(region, force=True)
+      region_map = fetch_region_stacks(region, stack_list)
+
+    with self._lock:
+      self.cache.setdefault(region, {})['stack_map'] = region_map
+    host_count = sum(len(each) for each in region_map.values())
+    self.region_status[region] = {'stacks': len(stack_list), 'hosts': host_count, 'stack_list_cached': cached}
+    log.info("Fetched %d host(s) from %d stack(s) in %s in %.2f seconds%s", host_count, len(stack_list), region,
+             time.time() - start_time, " (cached stack list)" if cached else "")
+    return region_map
+
+  def _stack_list(self, region, force=False):
+    """
+    :return: tuple of (stack list of the region, True if it came from the cache)
+    """
+    with self._lock:
+      entry = self.cache.get(region, {})
+    if not force and 'stacks' in entry and time.time() - entry.get('listed_at', 0) < self.stack_ttl:
+      return entry['stacks'], True
+
+    stack_list = list_stacks(region)
+    with self._lock:
+      self.cache.setdefault(region, {}).update(stacks=stack_list, listed_at=time.time())
+    return stack_list, False
+
+  def _save_cache(self):
+    if self.cache_file is None:
+      return
+    with self._lock:
+      content = json.dumps(self.cache, sort_keys=True)
+    try:
+      write_file_atomically(self.cache_file, content)
+    except (IOError, OSError) as e:
+      log.warning("Could not write the stack cache %s: %s", self.cache_file, e)
+
+
+fetcher = RegionFetcher(DEFAULT_REGIONS)
+
+
+def fetch_stack_map():
+  """
+  Fetch the instances of every stack in every region.
+  :return: dict of stack name -> dict of hostname -> private ip
+  """
+  return fetcher.fetch()
+
+
+def render_managed_block(stack_map):
+  """
+  :return: list of lines for the managed block, starting with the delimiter
+  """
+  managed_block = [HOSTS_DELIMITER]
+  for stack_name in sorted(stack_map):
+    for host_name in sorted(stack_map[stack_name]):
+      managed_block.append("{0} {1}-{2}".format(stack_map[stack_name][host_name], stack_name, host_name))
+  return managed_block
+
+
+def read_hosts_file(hosts_file):
+  """
+  Split the hosts file into the entries before the delimiter and the managed block.
+  :return: tuple of (unmanaged lines, managed lines)
+  """
+  unmanaged, managed = [], []
+  with open(hosts_file, 'r') as host_file:
     for each in host_file:
-      if hosts_delimeter in each:
-        break
-      opsworks_hosts.append(each.strip())
+      if managed or HOSTS_DELIMITER in each:
+        managed.append(each.strip())
+      else:
+        unmanaged.append(each.strip())
+  return unmanaged, managed
+
+
+def block_hash(lines):
+  return hashlib.sha1("\n".join(lines).encode('utf-8')).hexdigest()
+
+
+def write_file_atomically(path, content, mode=0o644):
+  """
+  Replace a file via a temporary file and rename, so readers never see a partially written file.
+  An existing file keeps its permissions.
+  """
+  if os.path.exists(path):
+    mode = os.stat(path).st_mode & 0o777
+  fd, temp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', dir=os.path.dirname(os.path.abspath(path)))
+  try:
+    with os.fdopen(fd, 'w') as temp_file:
+      temp_file.write(content)
+      temp_file.flush()
+      os.fsync(temp_file.fileno())
+    os.chmod(temp_path, mode)
+    os.rename(temp_path, path)
+  except:
+    os.unlink(temp_path)
+    raise
+
+
+def write_hosts_file(hosts_file, lines):
+  write_file_atomically(hosts_file, "".join(each + "\n" for each in lines))
+
+
+def apply_managed_block(hosts_file, managed_block):
+  """
+  Rewrite the managed block of the hosts file if it differs from managed_block.
+  :return: True if the file was rewritten
+  """
+  unmanaged, current_block = read_hosts_file(hosts_file)
+  if block_hash(managed_block) == block_hash(current_block):
+    log.info("Hosts unchanged, not rewriting %s", hosts_file)
+    return False
+
+  added = set(managed_block) - set(current_block)
+  removed = set(current_block) - set(managed_block)
+  for each in sorted(added):
+    log.info("Adding %s", each)
+  for each in sorted(removed):
+    log.info("Removing %s", each)
+
+  start_time = time.time()
+  write_hosts_file(hosts_file, unmanaged + managed_block)
+  log.info("Wrote %s in %.3f seconds", hosts_file, time.time() - start_time)
+  return True
+
+
+def refresh_hosts_file(hosts_file):
+  """
+  Rewrite the managed block of the hosts file if the OpsWorks instances changed.
+  :return: True if the file was rewritten
+  """
+  start_time = time.time()
+  stack_map = fetch_stack_map()
+  managed_block = render_managed_block(stack_map)
+  log.info("Fetched %d host(s) in %.2f seconds", len(managed_block) - 1, time.time() - start_time)
+  return apply_managed_block(hosts_file, managed_block)
 
-  with open('/etc/hosts', 'w') as host_file:
-    for each in opsworks_hosts:
-      host_file.write(each + "\n")
-    for each in custom_hosts:
-      host_file.write(each + "\n")
 
+def read_json(path):
+  try:
+    with open(path, 'r') as json_file:
+      return json.load(json_file)
+  except (IOError, ValueError):
+    return None
+
+
+def stack_map_checksum(stack_map):
+  return hashlib.sha1(json.dumps(stack_map, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class SnapshotRefresher(object):
+  """
+  Shares one view of the OpsWorks instances between many nodes through a shared directory
+  (e.g. an NFS/EFS mount).
+
+  The node holding the publisher lease fetches the instances from the API and writes a
+  versioned, checksummed snapshot.  Every other node only reads the snapshot, and applies
+  it when its version changes.  If the publisher goes away its lease expires and another
+  node takes over.
+
+  Each lease has a term number.  Taking over an expired lease means creating the claim file of
+  the next term with O_EXCL, which only one node can do, so nodes refreshing at the same moment
+  never both win.  Only the current owner renews a lease, and only before it expires.  The node
+  id is stable across runs (the hostname by default), so a publisher run from cron keeps its lease.
+  """
+  def __init__(self, snapshot_dir, role='auto', lease_seconds=300, node_id=None):
+    self.snapshot_path = os.path.join(snapshot_dir, SNAPSHOT_FILE)
+    self.lease_path = os.path.join(snapshot_dir, PUBLISHER_LEASE_FILE)
+    self.role = role
+    self.lease_seconds = lease_seconds
+    self.node_id = node_id or socket.gethostname()
+    self.applied_version = None
+
+  def __call__(self, hosts_file):
+    if self.role == 'publish' or (self.role == 'auto' and self.acquire_lease()):
+      self.publish()
+    return self.consume(hosts_file)
+
+  def acquire_lease(self):
+    """
+    Take or renew the publisher lease.
+    :return: True if this node is the publisher
+    """
+    lease = read_json(self.lease_path)
+    now = time.time()
+    if lease is None:
+      # continue after the newest claim, which is still held if it was made less than a lease ago
+      term, claimed_at = self._latest_claim()
+      lease = {'expires': claimed_at + self.lease_seconds, 'term': term}
+    term = lease.get('term', 0)
+    if lease.get('expires', 0) > now:
+      if lease.get('owner') != self.node_id:
+        return False
+    else:
+      # the lease expired (or never existed): whoever creates the claim of the next term takes over
+      term += 1
+      try:
+        fd = os.open("{0}.{1}".format(self.lease_path, term), os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+      except OSError:
+        return False
+      os.close(fd)
+      if lease.get('owner') not in (None, self.node_id):
+        log.info("Publisher lease of %s expired, taking over", lease.get('owner'))
+      try:
+        os.unlink("{0}.{1}".format(self.lease_path, term - 2))
+      except OSError:
+        pass
+
+    write_file_atomically(self.lease_path, json.dumps({'owner': self.node_id, 'term': term, 'expires': now + self.lease_seconds}))
+    return True
+
+  def _latest_claim(self):
+    """
+    :return: tuple of (highest lease term claimed in the directory, time it was claimed), (0, 0) if none
+    """
+    prefix = os.path.basename(self.lease_path) + '.'
+    terms = [int(each[len(prefix):]) for each in os.listdir(os.path.dirname(self.lease_path) or '.')
+             if each.startswith(prefix) and each[len(prefix):].isdigit()]
+    if not terms:
+      return 0, 0
+    try:
+      return max(terms), os.path.getmtime("{0}.{1}".format(self.lease_path, max(terms)))
+    except OSError:
+      return max(terms), time.time()
+
+  def publish(self):
+    """
+    Fetch the instances from the API and write a new snapshot version if they changed.
+    """
+    start_time = time.time()
+    stack_map = fetch_stack_map()
+    checksum = stack_map_checksum(stack_map)
+    log.info("Fetched %d stack(s) in %.2f seconds", len(stack_map), time.time() - start_time)
+
+    current = read_json(self.snapshot_path) or {}
+    if current.get('checksum') == checksum:
+      return
+
+    snapshot = {
+      'version': current.get('version', 0) + 1,
+      'checksum': checksum,
+      'generated_at': time.time(),
+      'publisher': self.node_id,
+      'stacks': stack_map
+    }
+    write_file_atomically(self.snapshot_path, json.dumps(snapshot, sort_keys=True))
+    log.info("Published snapshot version %d to %s", snapshot['version'], self.snapshot_path)
+
+  def consume(self, hosts_file):
+    """
+    Apply the shared snapshot to the hosts file if its version changed since the last refresh.
+    :return: True if the hosts file was rewritten
+    """
+    snapshot = read_json(self.snapshot_path)
+    if snapshot is None:
+      raise SnapshotError("No snapshot found at {0}".format(self.snapshot_path))
+    if stack_map_checksum(snapshot['stacks']) != snapshot['checksum']:
+      raise SnapshotError("Snapshot {0} version {1} failed its checksum".format(self.snapshot_path, snapshot['version']))
+
+    age = time.time() - snapshot['generated_at']
+    if age > 3 * self.lease_seconds:
+      log.warning("Snapshot version %d is %d seconds old, is a publisher running?", snapshot['version'], age)
+
+    if snapshot['version'] == self.applied_version:
+      return False
+    changed = apply_managed_block(hosts_file, render_managed_block(snapshot['stacks']))
+    self.applied_version = snapshot['version']
+    return changed
+
+
+def write_status(status_file, status):
+  if status_file is not None:
+    write_file_atomically(status_file, json.dumps(status, indent=2, sort_keys=True) + "\n")
+
+
+def watch(refresh, hosts_file, interval, max_interval, status_file):
+  """
+  Call refresh(hosts_file) every interval seconds, backing off up to max_interval seconds
+  while refreshes keep failing.  The result of each refresh is written to the status file.
+  """
+  status = {'last_refresh': None, 'last_success': None, 'latency_seconds': None,
+            'changed': False, 'consecutive_failures': 0, 'error': None}
+  while True:
+    start_time = time.time()
+    status['last_refresh'] = start_time
+    try:
+      status['changed'] = refresh(hosts_file)
+      status['last_success'] = start_time
+      status['consecutive_failures'] = 0
+      status['error'] = None
+    except Exception as e:
+      status['consecutive_failures'] += 1
+      status['error'] = str(e)
+      log.error("Refreshing %s failed: %s", hosts_file, e)
+    status['latency_seconds'] = round(time.time() - start_time, 3)
+    status['regions'] = fetcher.region_status
+    write_status(status_file, status)
+
+    delay = min(max_interval, interval * 2 ** status['consecutive_failures'])
+    time.sleep(delay)
+
+
+def parse_options():
+  parser = optparse.OptionParser()
+  parser.add_option('--hosts-file', default=HOSTS_FILE, help='hosts file to update (default: %default)')
+  parser.add_option('--regions', default=",".join(DEFAULT_REGIONS), help='comma separated OpsWorks regions to fetch stacks from (default: %default)')
+  parser.add_option('--region-timeout', type='int', default=30,
+                    help='seconds to wait for a region before using its last known hosts (default: %default)')
+  parser.add_option('--stack-cache', default=None, help='file to keep the stack list and last known hosts of each region in between runs')
+  parser.add_option('--stack-ttl', type='int', default=900, help='seconds a cached stack list is used before listing stacks again (default: %default)')
+  parser.add_option('--watch', action='store_true', default=False, help='keep running and refresh every --interval seconds')
+  parser.add_option('--interval', type='int', default=60, help='seconds between refreshes in watch mode (default: %default)')
+  parser.add_option('--max-interval', type='int', default=900, help='maximum backoff between failed refreshes (default: %default)')
+  parser.add_option('--status-file', default=None, help='file to write the last refresh time and latency to (JSON)')
+  parser.add_option('--pid-file', default=None, help='file to write the process id to in watch mode')
+  parser.add_option('--snapshot-dir', default=None, help='shared directory to publish/read host snapshots instead of every node calling the API')
+  parser.add_option('--role', type='choice', choices=['auto', 'publish', 'consume'], default='auto',
+                    help='snapshot role: auto (elect a publisher), publish or consume (default: %default)')
+  parser.add_option('--lease', type='int', default=300,
+                    help='seconds a publisher holds its lease without renewing it, must be longer than the refresh period (default: %default)')
+  parser.add_option('--node-id', default=None, help='stable name of this node for the publisher lease (default: the hostname)')
+  return parser.parse_args()[0]
+
+
+if __name__ == '__main__':
+  options = parse_options()
+  fetcher = RegionFetcher([each.strip() for each in options.regions.split(',') if each.strip()],
+                          options.stack_cache, options.stack_ttl, options.region_timeout)
+  refresh = refresh_hosts_file
+  if options.snapshot_dir is not None:
+    refresh = SnapshotRefresher(options.snapshot_dir, options.role, options.lease, options.node_id)
+
+  if options.watch:
+    if options.pid_file is not None:
+      write_file_atomically(options.pid_file, "{0}\n".format(os.getpid()))
+    watch(refresh, options.hosts_file, options.interval, options.max_interval, options.status_file)
 
+  try:
+    refresh(options.hosts_file)
+  except (ApiCallError, SnapshotError) as e:
+    log.error(str(e))
+    sys.exit(1)
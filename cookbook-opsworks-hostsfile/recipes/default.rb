@@ -27,10 +27,57 @@ cookbook_file node['opsworks_hostsfile']['script_location'] do
   group node['opsworks_hostsfile']['group']
 end
 
-cron 'opsworks-hosts' do
-  action :create
-  command node['opsworks_hostsfile']['script_location']
-  minute node['opsworks_hostsfile']['cron_frequency']
-  user node['opsworks_hostsfile']['user']
-  mailto '""'
+script_args = "--regions=#{node['opsworks_hostsfile']['regions'].join(',')}"
+if node['opsworks_hostsfile']['stack_cache_file']
+  script_args << " --stack-cache=#{node['opsworks_hostsfile']['stack_cache_file']}"
+end
+if node['opsworks_hostsfile']['snapshot_dir']
+  # the lease has to outlive the time between two refreshes, or the publisher loses it every time
+  lease = node['opsworks_hostsfile']['snapshot_lease']
+  if lease.nil?
+    if node['opsworks_hostsfile']['mode'] == 'service'
+      refresh_period = node['opsworks_hostsfile']['watch_interval'].to_i
+    elsif node['opsworks_hostsfile']['cron_frequency'] =~ %r{^\*/(\d+)$}
+      refresh_period = $1.to_i * 60
+    else
+      refresh_period = 3600
+    end
+    lease = [refresh_period * 3, 300].max
+  end
+  script_args << " --snapshot-dir=#{node['opsworks_hostsfile']['snapshot_dir']} --role=#{node['opsworks_hostsfile']['snapshot_role']} --lease=#{lease}"
+end
+
+if node['opsworks_hostsfile']['mode'] == 'service'
+  template '/etc/init.d/opsworks-hosts' do
+    source 'opsworks-hosts.init.erb'
+    mode 0755
+    owner 'root'
+    group 'root'
+    variables(
+      :script_location => node['opsworks_hostsfile']['script_location'],
+      :script_args => script_args,
+      :user => node['opsworks_hostsfile']['user'],
+      :interval => node['opsworks_hostsfile']['watch_interval'],
+      :status_file => node['opsworks_hostsfile']['status_file']
+    )
+    notifies :restart, 'service[opsworks-hosts]'
+  end
+
+  service 'opsworks-hosts' do
+    supports :status => true, :restart => true
+    action [:enable, :start]
+    subscribes :restart, "cookbook_file[#{node['opsworks_hostsfile']['script_location']}]"
+  end
+
+  cron 'opsworks-hosts' do
+    action :delete
+  end
+else
+  cron 'opsworks-hosts' do
+    action :create
+    command "#{node['opsworks_hostsfile']['script_location']} #{script_args}".strip
+    minute node['opsworks_hostsfile']['cron_frequency']
+    user node['opsworks_hostsfile']['user']
+    mailto '""'
+  end
 end
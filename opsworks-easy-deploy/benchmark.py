@@ -0,0 +1,139 @@
+#!/usr/bin/python
+
+#
+# Copyright 2014 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0
+#
+# or in the "license" file accompanying this file. This file is distributed
+# on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language governing
+# permissions and limitations under the License.
+#
+
+import time
+import click
+import botocore.session
+from botocore.stub import Stubber
+
+from easy_deploy import ClientPool
+import simulator
+
+DESCRIBE_DEPLOYMENTS_RESPONSE = {
+    'Deployments': [{'DeploymentId': 'deployment-1', 'Status': 'running'}]
+}
+
+
+def _stubbed_call(client, count):
+    """
+    Queue up `count` canned describe_deployments responses on the client and
+    return a function performing one call.  No request ever leaves the process.
+    """
+    stubber = Stubber(client)
+    for _ in range(count):
+        stubber.add_response('describe_deployments', DESCRIBE_DEPLOYMENTS_RESPONSE, {'DeploymentIds': ['deployment-1']})
+    stubber.activate()
+    return lambda: client.describe_deployments(DeploymentIds=['deployment-1'])
+
+
+def _client_per_call(session, calls):
+    start_time = time.time()
+    for _ in range(calls):
+        client = session.create_client('opsworks', 'us-east-1')
+        _stubbed_call(client, 1)()
+    return time.time() - start_time
+
+
+def _pooled_client(session, calls):
+    pool = ClientPool()
+    pool._session = session
+    start_time = time.time()
+    make_call = _stubbed_call(pool.get_client('opsworks', 'us-east-1'), calls)
+    for _ in range(calls):
+        pool.get_client('opsworks', 'us-east-1')
+        make_call()
+    return time.time() - start_time
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command(help='Compare creating a client per API call with reusing pooled clients')
+@click.option('--calls', type=click.INT, default=200, help='Number of API calls to make in each mode')
+def clients(calls):
+    session = botocore.session.get_session()
+    session.set_credentials('benchmark', 'benchmark')
+
+    per_call = _client_per_call(session, calls)
+    pooled = _pooled_client(session, calls)
+
+    click.echo("client per call: {0:.3f}s total, {1:.2f}ms per call".format(per_call, per_call * 1000 / calls))
+    click.echo("pooled client:   {0:.3f}s total, {1:.2f}ms per call".format(pooled, pooled * 1000 / calls))
+    click.echo("overhead removed: {0:.2f}ms per call ({1:.1f}x faster)".format((per_call - pooled) * 1000 / calls, per_call / pooled))
+
+
+def _parse_range(value):
+    """
+    Parse "60" or "60-120" into a fixed value or a (low, high) tuple.
+    """
+    if '-' in value:
+        low, high = value.split('-', 1)
+        return float(low), float(high)
+    return float(value)
+
+
+def _format_duration(seconds):
+    hours, remainder = divmod(int(round(seconds)), 3600)
+    minutes, seconds = divmod(remainder, 60)
+    return "{0}:{1:02d}:{2:02d}".format(hours, minutes, seconds)
+
+
+@cli.command(help='Simulate rollout strategies against fake OpsWorks/ELB APIs on a virtual clock')
+@click.option('--sizes', default='10,100,1000', help='Comma separated layer sizes to simulate')
+@click.option('--strategies', default=','.join(simulator.STRATEGIES), help='Comma separated strategies to simulate')
+@click.option('--zones', type=click.INT, default=3, help='Number of availability zones in the layer')
+@click.option('--deploy-duration', default='60-120', help='Deployment duration in seconds, fixed or a low-high range')
+@click.option('--failure-rate', type=click.FLOAT, default=0.0, help='Probability of a deployment failing on an instance')
+@click.option('--draining-timeout', type=click.INT, default=300, help='ELB connection draining timeout (0 disables draining)')
+@click.option('--healthy-threshold', type=click.INT, default=2, help='ELB HealthyThreshold')
+@click.option('--health-interval', type=click.INT, default=10, help='ELB health check Interval')
+@click.option('--warmup', default='0-15', help='Seconds until the application passes health checks after deploying')
+@click.option('--health-failure-rate', type=click.FLOAT, default=0.0, help='Probability of an instance never passing health checks after deploying')
+@click.option('--reboot-rate', type=click.FLOAT, default=0.0, help='Probability of an instance rebooting after an update (update strategies)')
+@click.option('--reboot-duration', default='60-180', help='Seconds an instance takes to reboot and come back online after an update')
+@click.option('--no-elb', is_flag=True, default=False, help='Simulate a layer without a load balancer')
+@click.option('--seed', type=click.INT, default=0, help='Random seed')
+@click.option('--breakdown', is_flag=True, default=False, help='Show phase durations and the number of calls per API operation')
+def rollout(sizes, strategies, zones, deploy_duration, failure_rate, draining_timeout, healthy_threshold,
+            health_interval, warmup, health_failure_rate, reboot_rate, reboot_duration, no_elb, seed, breakdown):
+    click.echo("{0:<14} {1:>9} {2:>10} {3:>11} {4:>10} {5:>14} {6:>9}".format(
+        'strategy', 'instances', 'outcome', 'rollout', 'api calls', 'min in service', 'real (s)'))
+
+    for size in [int(each) for each in sizes.split(',')]:
+        for strategy in strategies.split(','):
+            config = simulator.SimulationConfig(instances=size, zones=zones, deploy_duration=_parse_range(deploy_duration),
+                                                failure_rate=failure_rate, elb=not no_elb, draining_timeout=draining_timeout,
+                                                healthy_threshold=healthy_threshold, health_interval=health_interval,
+                                                warmup=_parse_range(warmup), health_failure_rate=health_failure_rate,
+                                                reboot_rate=reboot_rate, reboot_duration=_parse_range(reboot_duration), seed=seed)
+            start_time = time.time()
+            result = simulator.simulate(strategy, config)
+            click.echo("{0:<14} {1:>9} {2:>10} {3:>11} {4:>10} {5:>14} {6:>9.2f}".format(
+                strategy, size, result.outcome, _format_duration(result.duration), result.total_calls,
+                result.min_in_service, time.time() - start_time))
+
+            if breakdown:
+                for name, (count, p50, p95, longest) in sorted(result.phases.items()):
+                    click.echo("    {0}: {1}x, p50 {2:.0f}s, p95 {3:.0f}s, max {4:.0f}s".format(name, count, p50, p95, longest))
+                for (service_name, api_operation), count in sorted(result.calls.items()):
+                    click.echo("    {0}.{1}: {2}".format(service_name, api_operation, count))
+
+
+if __name__ == '__main__':
+    cli()
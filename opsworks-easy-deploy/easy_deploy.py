@@ -20,20 +20,626 @@ import os
 import sys
 import time
 import json
+import math
+import random
+import socket
+import threading
+import collections
+import contextlib
+import re
+import tempfile
 import arrow
+import botocore.exceptions
 import botocore.session
+from botocore.exceptions import ClientError, EndpointConnectionError
+
+
+class Clock(object):
+    """
+    Source of time, waits and threads for everything in this module.  The simulator
+    replaces the module level CLOCK with a virtual clock to run rollouts without waiting.
+    """
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def event(self):
+        return threading.Event()
+
+    def semaphore(self, value):
+        return threading.Semaphore(value)
+
+    def start_thread(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+class ClientPool(object):
+    """
+    Process wide pool of botocore clients, one per (service, region).
+
+    Creating a client loads the service model and sets up a fresh HTTP connection
+    pool, so each client is created once and reused for every subsequent call.  botocore's
+    own retries are turned off, Operation._make_api_call retries and backs off itself.
+    """
+    def __init__(self):
+        self._session = None
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        with self._lock:
+            if self._session is None:
+                self._session = botocore.session.get_session()
+            return self._session
+
+    def get_client(self, service_name, region):
+        session = self.session
+        key = (service_name, region)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = session.create_client(service_name, region)
+                self._disable_retries(client)
+                self._clients[key] = client
+        return client
+
+    @staticmethod
+    def _disable_retries(client):
+        """
+        Unregister botocore's retry handler, so throttling errors reach the rate limiter
+        instead of being retried (several times per call) inside botocore.
+        """
+        service_model = client.meta.service_model
+        event_names = [service_model.endpoint_prefix]
+        if getattr(service_model, 'service_id', None) is not None:
+            event_names.append(service_model.service_id.hyphenize())
+        for each in event_names:
+            client.meta.events.unregister('needs-retry.{0}'.format(each), unique_id='retry-config-{0}'.format(each))
+
+    def clear(self):
+        with self._lock:
+            self._session = None
+            self._clients = {}
+
+
+class MetadataCache(object):
+    """
+    In-process cache of describe results that do not change during a run (stacks, layers,
+    apps and layer load balancers).  Concurrent lookups of the same key share a single call.
+    """
+    def __init__(self):
+        self._results = {}
+        self._loaded_at = {}
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, loader):
+        with self._lock:
+            if key in self._results:
+                return self._results[key]
+            loading = self._loading.get(key)
+            if loading is None:
+                loading = self._loading[key] = CLOCK.event()
+                is_loader = True
+            else:
+                is_loader = False
+
+        if not is_loader:
+            loading.wait()
+            return self.get(key, loader)
+
+        try:
+            result = loader()
+            with self._lock:
+                self._results[key] = result
+                self._loaded_at[key] = CLOCK.time()
+            return result
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+            loading.set()
+
+    def items(self):
+        with self._lock:
+            return list(self._results.items())
+
+    def expire(self, max_age):
+        """
+        Forget results loaded more than max_age seconds ago, for processes that outlive a run.
+        """
+        with self._lock:
+            oldest = CLOCK.time() - max_age
+            for key in [key for key, loaded_at in self._loaded_at.items() if loaded_at < oldest]:
+                del self._results[key]
+                del self._loaded_at[key]
+
+    def clear(self):
+        with self._lock:
+            self._results = {}
+            self._loaded_at = {}
+            self._loading = {}
+
+
+class StatusPoller(object):
+    """
+    Polls the status of many outstanding items (e.g. deployments) with a single API call per
+    round from a background thread, and wakes each waiting caller as soon as its item is done.
+
+    Rounds start min_delay seconds apart and slow down as the youngest outstanding item ages
+    (age * backoff, capped at max_delay).  Each delay is jittered so pollers don't synchronise.
+    """
+    def __init__(self, fetch, is_done, on_status=None, min_delay=2, max_delay=30, backoff=0.1, jitter=0.2):
+        """
+        :param fetch: function taking a list of keys and returning a dict of key -> status
+        :param is_done: function returning True when a status is final
+        :param on_status: optional function called with (key, status) when a status changes
+        """
+        self._fetch = fetch
+        self._is_done = is_done
+        self._on_status = on_status
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.jitter = jitter
+
+        self._waiters = {}
+        self._lock = threading.Lock()
+        self._wakeup = CLOCK.event()
+        self._thread = None
+
+    def wait(self, key, timeout=None):
+        """
+        Block until the item is done.
+        :param key: item to wait for
+        :param timeout: maximum number of seconds to wait, or None to wait forever
+        :return: the final status, or None if the timeout expired first
+        """
+        with self._lock:
+            waiter = self._waiters.get(key)
+            if waiter is None:
+                waiter = {'event': CLOCK.event(), 'status': None, 'error': None, 'added': CLOCK.time(), 'waiting': 0,
+                          'log_context': save_log_context()}
+                self._waiters[key] = waiter
+            waiter['waiting'] += 1
+            if self._thread is None:
+                self._thread = spawn(self._run)
+        self._wakeup.set()
+
+        waiter['event'].wait(timeout)
+
+        with self._lock:
+            waiter['waiting'] -= 1
+            if not waiter['event'].is_set():
+                if waiter['waiting'] == 0:
+                    self._waiters.pop(key, None)
+                return None
+
+        if waiter['error'] is not None:
+            raise waiter['error']
+        return waiter['status']
+
+    def _next_delay(self, youngest_age):
+        delay = min(self.max_delay, max(self.min_delay, youngest_age * self.backoff))
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _run(self):
+        # the poller is shared, so its messages don't belong to the caller that started it;
+        # status changes are logged to the context of the caller waiting for the item
+        restore_log_context({})
+        last_poll = CLOCK.time()
+        while True:
+            with self._lock:
+                if not self._waiters:
+                    self._thread = None
+                    return
+                youngest_age = CLOCK.time() - max(waiter['added'] for waiter in self._waiters.values())
+                self._wakeup.clear()
+
+            # a new waiter sets _wakeup, so the delay is recalculated from its (younger) age
+            remaining = last_poll + self._next_delay(youngest_age) - CLOCK.time()
+            if remaining > 0:
+                self._wakeup.wait(remaining)
+                continue
+
+            last_poll = CLOCK.time()
+            with self._lock:
+                keys = list(self._waiters)
+                waiter_metrics = []
+                for waiter in self._waiters.values():
+                    metrics = waiter['log_context'].get('metrics') or METRICS
+                    if metrics not in waiter_metrics:
+                        waiter_metrics.append(metrics)
+            # the API calls of a round are made for all its waiters, so they are recorded in each waiter's metrics
+            LOG_CONTEXT.metrics = waiter_metrics[0] if len(waiter_metrics) == 1 else SharedMetrics(waiter_metrics)
+            try:
+                statuses = self._fetch(keys)
+            except BaseException as e:
+                with self._lock:
+                    for key in keys:
+                        waiter = self._waiters.pop(key, None)
+                        if waiter is not None:
+                            waiter['error'] = e
+                            waiter['event'].set()
+                continue
+
+            with self._lock:
+                for key, status in statuses.items():
+                    waiter = self._waiters.get(key)
+                    if waiter is None:
+                        continue
+                    if self._on_status is not None and status != waiter['status']:
+                        restore_log_context(waiter['log_context'])
+                        try:
+                            self._on_status(key, status)
+                        finally:
+                            restore_log_context({})
+                    waiter['status'] = status
+                    if self._is_done(status):
+                        del self._waiters[key]
+                        waiter['event'].set()
+
+
+class CallBatcher(object):
+    """
+    Combines the items submitted by concurrent callers within delay seconds into a single call,
+    e.g. registering every instance of a batch with a load balancer in one request.  Every
+    caller gets the result of (or the exception raised by) the combined call.
+    """
+    def __init__(self, call, delay=0.5):
+        """
+        :param call: function taking the list of submitted items
+        """
+        self._call = call
+        self.delay = delay
+
+        self._pending = None
+        self._lock = threading.Lock()
+
+    def submit(self, item):
+        with self._lock:
+            batch = self._pending
+            if batch is None:
+                batch = self._pending = {'items': [], 'done': CLOCK.event(), 'result': None, 'error': None}
+                spawn(self._flush, batch)
+            batch['items'].append(item)
+
+        batch['done'].wait()
+        if batch['error'] is not None:
+            raise batch['error']
+        return batch['result']
+
+    def _flush(self, batch):
+        CLOCK.sleep(self.delay)
+        with self._lock:
+            self._pending = None
+        try:
+            batch['result'] = self._call(batch['items'])
+        except BaseException as e:
+            batch['error'] = e
+        finally:
+            batch['done'].set()
+
+
+class RateLimiter(object):
+    """
+    Token bucket shared by every call to a service in a region.
+
+    The rate is halved whenever the service throttles a call and recovers gradually towards
+    the configured rate as calls succeed.  Time spent waiting for tokens is recorded so the
+    configured rates can be tuned.
+    """
+    def __init__(self, rate, burst=None, min_rate=0.2):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.min_rate = min_rate
+        self.burst = burst if burst is not None else max(1.0, self.max_rate)
+
+        self.calls = 0
+        self.throttles = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+        self._tokens = self.burst
+        self._last_refill = CLOCK.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token, sleeping until one is available.
+        :return: number of seconds waited
+        """
+        with self._lock:
+            now = CLOCK.time()
+            self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+            self._last_refill = now
+            self._tokens -= 1
+            wait = max(0.0, -self._tokens / self.rate)
+
+            self.calls += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+        if wait > 0:
+            CLOCK.sleep(wait)
+        return wait
+
+    def throttled(self):
+        with self._lock:
+            self.throttles += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def succeeded(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+
+    def summary(self):
+        with self._lock:
+            return "{0} calls, waited {1:.1f}s in total (max {2:.1f}s), throttled {3} time(s), current rate {4:.2f}/s".format(
+                self.calls, self.total_wait, self.max_wait, self.throttles, self.rate)
+
+
+class Metrics(object):
+    """
+    Records timing spans for rollout phases and API calls.  Every span is kept for the end of
+    run summary (unless retain is False, e.g. in long running processes) and, when a metrics
+    file is open, written to it as a JSON line.
+    """
+    def __init__(self):
+        self.spans = []
+        self.retain = True
+        self._file = None
+        self._lock = threading.Lock()
+
+    def open(self, path):
+        with self._lock:
+            self._file = open(path, 'a')
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def clear(self):
+        with self._lock:
+            self.spans = []
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        """
+        Time the enclosed block.  The attributes dict is yielded so the block can add to it,
+        e.g. a deployment id only known once the deployment has been created.
+        """
+        prefix = getattr(LOG_CONTEXT, 'prefix', None)
+        if prefix is not None:
+            attributes['target'] = prefix
+        start_time = CLOCK.time()
+        status = 'error'
+        try:
+            yield attributes
+            status = 'ok'
+        finally:
+            end_time = CLOCK.time()
+            self.record(dict(attributes, name=name, start=start_time, end=end_time,
+                             duration=end_time - start_time, status=status))
+
+    def record(self, span):
+        with self._lock:
+            if self.retain:
+                self.spans.append(span)
+            if self._file is not None:
+                self._file.write(json.dumps(span, sort_keys=True) + "\n")
+                self._file.flush()
+
+    def phase_stats(self):
+        """
+        :return: dict of phase name to (count, p50, p95, max) duration
+        """
+        durations = collections.defaultdict(list)
+        for span in self._snapshot():
+            if span['name'] != 'api_call':
+                durations[span['name']].append(span['duration'])
+        return dict((name, (len(values), percentile(values, 50), percentile(values, 95), max(values)))
+                    for name, values in durations.items())
+
+    def summary(self, slowest=10):
+        spans = self._snapshot()
+        if not spans:
+            return []
+
+        lines = ["Phase durations:"]
+        for name, (count, p50, p95, longest) in sorted(self.phase_stats().items()):
+            lines.append("  {0:<12} {1:>5}x  p50 {2:7.1f}s  p95 {3:7.1f}s  max {4:7.1f}s".format(name, count, p50, p95, longest))
+
+        api_calls = collections.defaultdict(list)
+        for span in spans:
+            if span['name'] == 'api_call':
+                api_calls[(span['service'], span['operation'])].append(span)
+        lines.append("API calls:")
+        for (service_name, api_operation), calls in sorted(api_calls.items()):
+            durations = [each['duration'] for each in calls]
+            lines.append("  {0:<48} {1:>6}x  {2:8.1f}s total  p50 {3:.2f}s  p95 {4:.2f}s  rate limit wait {5:.1f}s  errors {6}".format(
+                service_name + '.' + api_operation, len(calls), sum(durations), percentile(durations, 50), percentile(durations, 95),
+                sum(each['rate_limit_wait'] for each in calls), len([each for each in calls if each['status'] != 'ok'])))
+
+        instances = collections.OrderedDict()
+        for span in spans:
+            if 'instance' in span:
+                instances.setdefault((span.get('target'), span['instance']), []).append(span)
+        totals = [(key, [each for each in instance_spans if each['name'] == 'instance']) for key, instance_spans in instances.items()]
+        totals = sorted(((key, total[0]['duration']) for key, total in totals if total), key=lambda each: -each[1])
+        if totals:
+            lines.append("Critical path per instance (slowest {0} of {1}):".format(min(slowest, len(totals)), len(totals)))
+            for (target, instance), total in totals[:slowest]:
+                phases = ", ".join("{0} {1:.0f}s".format(each['name'], each['duration']) for each in instances[(target, instance)] if each['name'] != 'instance')
+                lines.append("  {0}  {1:.0f}s: {2}".format(instance if target is None else "[{0}] {1}".format(target, instance), total, phases))
+        return lines
+
+    def _snapshot(self):
+        with self._lock:
+            return list(self.spans)
+
+
+class SharedMetrics(Metrics):
+    """
+    Records every span in several Metrics, e.g. an API call polling on behalf of several daemon jobs.
+    """
+    def __init__(self, targets):
+        Metrics.__init__(self)
+        self._targets = targets
+
+    def record(self, span):
+        for each in self._targets:
+            each.record(dict(span))
+
+
+def percentile(values, pct):
+    """
+    Nearest rank percentile of a non-empty list of numbers.
+    """
+    ordered = sorted(values)
+    return ordered[max(0, int(math.ceil(len(ordered) * pct / 100.0)) - 1)]
+
+
+class Journal(object):
+    """
+    Per-instance progress of a rolling deployment, written to disk after every step so an
+    interrupted rollout can be resumed.  Each instance goes through the states deregistering
+    (with the load balancers it is taken out of), deregistered, deploying (with the deployment
+    id), deployed and completed.
+    """
+    def __init__(self, path, identity, resume=False):
+        self.path = path
+        self.identity = identity
+        self.instances = {}
+        self._lock = threading.Lock()
+
+        if not resume:
+            if os.path.exists(path):
+                log("Starting over, the journal of an interrupted rollout at {0} will be replaced (use --resume to continue it)".format(path))
+            return
+
+        if not os.path.exists(path):
+            log("No journal found at {0}, starting from the first instance".format(path))
+            return
+        with open(path, 'r') as journal_file:
+            content = json.load(journal_file)
+        if content.get('identity') != identity:
+            log("Journal {0} is for a different rollout ({1}).  Aborting".format(path, content.get('identity')))
+            sys.exit(1)
+        self.instances = content['instances']
+        log("Resuming from journal {0}".format(path))
+
+    def state(self, instance_id):
+        with self._lock:
+            return dict(self.instances.get(instance_id, {}))
+
+    def update(self, instance_id, state, **details):
+        with self._lock:
+            entry = self.instances.setdefault(instance_id, {})
+            entry.update(details, state=state, updated_at=CLOCK.time())
+            self._save()
+
+    def finish(self):
+        """
+        The rollout completed, so there is nothing left to resume.
+        """
+        with self._lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def _save(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, temp_path = tempfile.mkstemp(prefix='.' + os.path.basename(self.path) + '.', dir=directory)
+        with os.fdopen(fd, 'w') as temp_file:
+            json.dump({'identity': self.identity, 'instances': self.instances}, temp_file, indent=2, sort_keys=True)
+        os.rename(temp_path, self.path)
+
+
+def default_journal_file(identity):
+    """
+    Journal location for a rollout: one file per identity (region, stack, layer, command and
+    anything else the operation adds, e.g. the application) under STATE_DIR
+    """
+    leading = [key for key in ('region', 'stack', 'layer', 'command') if key in identity]
+    keys = leading + sorted(key for key in identity if key not in leading)
+    name = "-".join(str(identity[key]) for key in keys)
+    return os.path.join(STATE_DIR, re.sub(r'[^\w.-]+', '_', name) + '.journal.json')
+
+
+def open_journal(operation, journal_file, resume):
+    identity = operation.journal_identity()
+    return Journal(journal_file or default_journal_file(identity), identity, resume)
+
+
+CLOCK = Clock()
+CLIENT_POOL = ClientPool()
+METADATA_CACHE = MetadataCache()
+DEPLOYMENT_POLLERS = MetadataCache()
+HEALTH_POLLERS = MetadataCache()
+REBOOT_POLLERS = MetadataCache()
+ELB_BATCHERS = MetadataCache()
+RATE_LIMITERS = MetadataCache()
+METRICS = Metrics()
+LOG_CONTEXT = threading.local()
+LOG_CONTEXT_FIELDS = ('prefix', 'sink', 'metrics')
+
+# Journals and the daemon socket live here by default
+STATE_DIR = os.path.join(os.path.expanduser('~'), '.easy_deploy')
+DAEMON_SOCKET = os.path.join(STATE_DIR, 'daemon.sock')
+
+# Default maximum API calls per second for each service, shared by all operations in the process
+DEFAULT_API_RATES = {'opsworks': 5.0, 'elb': 10.0, 'ec2': 10.0}
+
+MAX_API_ATTEMPTS = 8
+THROTTLING_ERRORS = ('Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'RequestThrottled')
+TRANSIENT_ERRORS = ('InternalFailure', 'InternalError', 'ServiceUnavailable', 'RequestTimeout')
+# calls that may have taken effect even though they failed, so they are only retried when throttled or never sent
+NON_IDEMPOTENT_OPERATIONS = ('create_deployment',)
+# seconds between ELB health checks while a pipelined rollout waits for instances to come back in service
+CAPACITY_POLL_INTERVAL = 10
+# failures to send a request or read its response.  HTTPClientError and ConnectionError are their base
+# classes from botocore 1.11, older versions raise ReadTimeoutError and ConnectionClosedError directly
+CONNECTION_ERRORS = tuple(getattr(botocore.exceptions, name) for name in ('HTTPClientError', 'ConnectionError', 'ReadTimeoutError', 'ConnectionClosedError')
+                          if hasattr(botocore.exceptions, name))
+
+# Custom JSON key recording the application revision a deployment deployed (see --incremental)
+REVISION_JSON_KEY = 'easy_deploy_revision'
+# source revisions that always name the same code: a commit SHA or a version tag (branch names move)
+PINNED_REVISION_PATTERN = re.compile(r'^([0-9a-fA-F]{7,40}|(refs/tags/)?v?\d+(\.\d+)*([-+.][\w.-]+)?|refs/tags/.+)$')
+
+# OutOfService descriptions (ReasonCode 'Instance') that will not recover by waiting longer
+TERMINAL_HEALTH_REASONS = ('stopping state', 'stopped state', 'shutting-down state', 'terminated state')
+
+# OpsWorks and EC2 states an instance will not come back online from by itself
+FAILED_OPSWORKS_STATUSES = ('stopped', 'stopping', 'terminated', 'terminating', 'shutting_down', 'start_failed', 'setup_failed', 'connection_lost')
+FAILED_EC2_STATES = ('stopped', 'stopping', 'terminated', 'shutting-down')
 
 
 class Operation(object):
     def __init__(self, context):
-        self.session = botocore.session.get_session()
+        self.clients = CLIENT_POOL
+        self.metadata = METADATA_CACHE
+        self.api_rates = dict(DEFAULT_API_RATES, **context.obj.get('API_RATES', {}))
         self.service_endpoints = {
             'opsworks': context.obj['OPSWORKS_REGION'],
-            'elb': context.obj['ELB_REGION']
+            'elb': context.obj['ELB_REGION'],
+            'ec2': context.obj['ELB_REGION']
         }
         self.stack_name = None
         self.layer_name = None
         self.deploy_timeout = None
+        self.journal = None
+        self.load_balancer_names = []
+        self.load_balancer_tags = {}
         self._stack_id = None
         self._layer_id = None
 
@@ -48,7 +654,7 @@ class Operation(object):
     @property
     def stack_id(self):
         if self._stack_id is None:
-            stacks = self._make_api_call('opsworks', 'describe_stacks')['Stacks']
+            stacks = self._describe_cached('opsworks', 'describe_stacks')['Stacks']
             stack_names = [stack['Name'] for stack in stacks]
             for stack in stacks:
                 stack_id = stack['StackId']
@@ -63,7 +669,7 @@ class Operation(object):
     @property
     def layer_id(self):
         if self._layer_id is None:
-            layers = self._make_api_call('opsworks', 'describe_layers', StackId=self.stack_id)['Layers']
+            layers = self._describe_cached('opsworks', 'describe_layers', StackId=self.stack_id)['Layers']
             layer_names = [each_layer['Name'] for each_layer in layers]
             for each_layer in layers:
                 layer_id = each_layer['LayerId']
@@ -75,107 +681,500 @@ class Operation(object):
                 sys.exit(1)
         return self._layer_id
 
-    def layer_at_once(self, comment, exclude_hosts=None):
+    def layer_at_once(self, comment, exclude_hosts=None, custom_json='{}'):
         all_instances = self._make_api_call('opsworks', 'describe_instances', LayerId=self.layer_id)
 
         if exclude_hosts is None:
             exclude_hosts = []
 
-        deployment_instance_ids = []
+        deployment_instances = []
         for each in all_instances['Instances']:
             if each['Status'] == 'online' and each['Hostname'] not in exclude_hosts:
-                deployment_instance_ids.append(each['InstanceId'])
-        self._deploy_to(InstanceIds=deployment_instance_ids, Name="{0} instances".format(self.layer_name), Comment=comment)
+                deployment_instances.append(each)
 
-    def layer_rolling(self, comment, custom_json):
-        load_balancer_name = self._get_opsworks_elb_name()
+        deployment_instance_ids = [each['InstanceId'] for each in self._stale_instances(deployment_instances)]
+        if not deployment_instance_ids:
+            log("No instances left to deploy to")
+            return
+        self._deploy_to(InstanceIds=deployment_instance_ids, Name="{0} instances".format(self.layer_name), Comment=comment, CustomJson=custom_json)
 
-        if load_balancer_name is not None:
+    def layer_rolling(self, comment, custom_json, batch_size=1, batch_percent=None, min_in_service=None, pipeline=False, max_out_of_service=2):
+        load_balancer_names = self._get_load_balancer_names()
+        load_balancer_members = self._get_load_balancer_members(load_balancer_names)
+
+        all_instances = self._make_api_call('opsworks', 'describe_instances', LayerId=self.layer_id)
+        online_instances = [each for each in all_instances['Instances'] if each['Status'] == 'online']
+
+        if load_balancer_names:
+            for load_balancer_name in load_balancer_names:
+                layer_members = [each for each in online_instances if each['Ec2InstanceId'] in load_balancer_members[load_balancer_name]]
+                log("Instances will be taken out of ELB {0} while deploying ({1} of {2} online instance(s) registered)".format(
+                    load_balancer_name, len(layer_members), len(online_instances)))
             self.pre_deployment_hooks.append(self._remove_instance_from_elb)
             self.post_deployment_hooks.append(self._add_instance_to_elb)
 
-        all_instances = self._make_api_call('opsworks', 'describe_instances', LayerId=self.layer_id)
-        for each in all_instances['Instances']:
-            if each['Status'] != 'online':
+        if batch_percent is not None:
+            batch_size = int(math.ceil(len(online_instances) * batch_percent / 100.0))
+        batch_size = max(batch_size, 1)
+
+        zone_totals = collections.defaultdict(int)
+        for each in online_instances:
+            zone_totals[each.get('AvailabilityZone')] += 1
+
+        def deployment_kwargs(each):
+            # an instance interrupted by a previous run is no longer registered with its ELBs, the journal remembers them
+            instance_load_balancers = self._journal_state(InstanceIds=[each['InstanceId']]).get('load_balancers')
+            if instance_load_balancers is None:
+                instance_load_balancers = [name for name in load_balancer_names if each['Ec2InstanceId'] in load_balancer_members[name]]
+            return dict(InstanceIds=[each['InstanceId']], Name=each['Hostname'], Comment=comment, LoadBalancerNames=instance_load_balancers,
+                        Ec2InstanceId=each['Ec2InstanceId'], CustomJson=custom_json)
+
+        pending = list(online_instances)
+        if self.journal is not None:
+            pending = self._resume_interrupted(pending, deployment_kwargs)
+        pending = self._stale_instances(pending)
+
+        if pipeline:
+            if min_in_service is not None and not load_balancer_members:
+                max_out_of_service = min(max_out_of_service, len(online_instances) - min_in_service)
+                if max_out_of_service < 1:
+                    log("Taking any instance out of service would leave fewer than {0} instance(s) in service.  Aborting".format(min_in_service))
+                    sys.exit(1)
+
+            ordered = []
+            while pending:
+                ordered.extend(self._next_batch(pending, max_out_of_service, zone_totals))
+            self._pipelined_rollout([deployment_kwargs(each) for each in ordered], max_out_of_service,
+                                    load_balancer_members if min_in_service is not None else {}, min_in_service)
+        else:
+            while pending:
+                batch = self._next_batch(pending, batch_size, zone_totals)
+                if min_in_service is not None:
+                    batch = self._limit_batch_to_capacity(batch, pending, load_balancer_members, len(online_instances), min_in_service)
+
+                if len(batch) > 1:
+                    log("Deploying to batch of {0} instances: {1}".format(len(batch), ", ".join(each['Hostname'] for each in batch)))
+                run_concurrently(lambda each: self._deploy_to(**deployment_kwargs(each)), batch)
+
+        if self.journal is not None:
+            self.journal.finish()
+
+    def _resume_interrupted(self, instances, deployment_kwargs):
+        """
+        Finish the instances the journal has between deregistration and completion first, so the
+        instances left out of service by the previous run are put back as soon as possible.  An
+        instance interrupted while deregistering is taken out of its load balancers again.
+        :return: the instances that still have to be deployed
+        """
+        states = dict((each['InstanceId'], self.journal.state(each['InstanceId']).get('state')) for each in instances)
+        completed = [each for each in instances if states[each['InstanceId']] == 'completed']
+        interrupted = [each for each in instances if states[each['InstanceId']] not in (None, 'completed')]
+
+        if completed:
+            log("Skipping {0} instance(s) completed by a previous run: {1}".format(len(completed), ", ".join(each['Hostname'] for each in completed)))
+        if interrupted:
+            log("Finishing {0} instance(s) interrupted by a previous run: {1}".format(len(interrupted), ", ".join(each['Hostname'] for each in interrupted)))
+            run_concurrently(lambda each: self._deploy_to(**deployment_kwargs(each)), interrupted)
+
+        return [each for each in instances if states[each['InstanceId']] is None]
+
+    def _stale_instances(self, instances):
+        """
+        Instances that need the operation.  Overridden by operations that can tell when an
+        instance is already up to date.
+        """
+        return list(instances)
+
+    def journal_identity(self):
+        """
+        What a journal must match to be resumed by this operation
+        """
+        return {'region': self.service_endpoints['opsworks'], 'stack': self.stack_name, 'layer': self.layer_name, 'command': self.command}
+
+    def _pipelined_rollout(self, deployments, max_out_of_service, load_balancer_members=None, min_in_service=None):
+        """
+        Deploy to each instance in turn, starting the next instance as soon as one of the
+        max_out_of_service slots is free, so draining, deploying and warming up of different
+        instances overlap.  At most max_out_of_service instances are between the pre and post
+        deployment hooks at any time.  With load_balancer_members, an instance is only started once
+        taking it out leaves at least min_in_service instances InService in each of its load balancers.
+        :param deployments: list of _deploy_to keyword arguments, one per instance, in rollout order
+        :param max_out_of_service: maximum number of instances out of service at once
+        :param load_balancer_members: dict of load balancer name -> set of registered EC2 instance ids
+        """
+        slots = CLOCK.semaphore(max_out_of_service)
+        errors = []
+        threads = []
+        out_of_service = set()
+        lock = threading.Lock()
+
+        def run_stages(kwargs):
+            try:
+                self._deploy_to(**kwargs)
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                with lock:
+                    out_of_service.discard(kwargs['Ec2InstanceId'])
+                slots.release()
+
+        for kwargs in deployments:
+            slots.acquire()
+            while not errors and load_balancer_members:
+                with lock:
+                    started = set(out_of_service)
+                blocked = self._blocked_load_balancers(kwargs, started, load_balancer_members, min_in_service)
+                if not blocked:
+                    break
+                if not started:
+                    log("Deploying to {0} would leave fewer than {1} instance(s) in service in ELB(s) {2}.  Aborting".format(
+                        kwargs['Name'], min_in_service, ", ".join(blocked)))
+                    sys.exit(1)
+                CLOCK.sleep(CAPACITY_POLL_INTERVAL)
+            if errors:
+                break
+            with lock:
+                out_of_service.add(kwargs['Ec2InstanceId'])
+            threads.append(spawn(run_stages, kwargs))
+
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise errors[0]
+
+    def _blocked_load_balancers(self, kwargs, out_of_service, load_balancer_members, min_in_service):
+        """
+        The load balancers of the instance that would be left with fewer than min_in_service
+        instances InService (or all but one of their members) without it, as in _limit_batch_to_capacity.
+        :param out_of_service: EC2 instance ids already being taken out of service
+        :return: sorted list of load balancer names, empty if the instance can be taken out of service
+        """
+        blocked = []
+        for load_balancer_name in kwargs['LoadBalancerNames']:
+            in_service = self._in_service_instances(load_balancer_name) - out_of_service
+            floor = min(min_in_service, max(len(load_balancer_members[load_balancer_name]) - 1, 0))
+            if kwargs['Ec2InstanceId'] in in_service and len(in_service) - 1 < floor:
+                blocked.append(load_balancer_name)
+        return sorted(blocked)
+
+    @staticmethod
+    def _next_batch(pending, batch_size, zone_totals):
+        """
+        Take up to batch_size instances from pending, spread round robin across availability zones.
+        An availability zone with more than one instance never has all of them in the same batch.
+        :param pending: list of OpsWorks instances still to be deployed (modified in place)
+        :param batch_size: maximum number of instances in the batch
+        :param zone_totals: number of online instances in the layer for each availability zone
+        :return: list of instances in the batch
+        """
+        zones = collections.defaultdict(list)
+        for each in pending:
+            zones[each.get('AvailabilityZone')].append(each)
+
+        batch = []
+        taken = collections.defaultdict(int)
+        while len(batch) < batch_size:
+            picked = False
+            for zone in sorted(zones, key=lambda zone: -len(zones[zone])):
+                zone_limit = max(zone_totals[zone] - 1, 1)
+                if len(batch) < batch_size and zones[zone] and taken[zone] < zone_limit:
+                    batch.append(zones[zone].pop(0))
+                    taken[zone] += 1
+                    picked = True
+            if not picked:
+                break
+
+        for each in batch:
+            pending.remove(each)
+        return batch
+
+    def _limit_batch_to_capacity(self, batch, pending, load_balancer_members, online_count, min_in_service):
+        """
+        Shrink the batch so that taking it out of service leaves at least min_in_service instances
+        in service in each load balancer (or all but one of its instances, for a load balancer with
+        fewer members).  An instance only counts against the load balancers it is registered with.
+        Without load balancers the floor applies to the online instances of the layer.  Instances
+        that do not fit are put back at the front of pending.
+        :param load_balancer_members: dict of load balancer name -> set of registered EC2 instance ids
+        """
+        in_service = {}
+        allowed = {}
+        for load_balancer_name, members in load_balancer_members.items():
+            in_service[load_balancer_name] = self._in_service_instances(load_balancer_name)
+            floor = min(min_in_service, max(len(members) - 1, 0))
+            allowed[load_balancer_name] = len(in_service[load_balancer_name]) - floor
+        if not load_balancer_members:
+            in_service[None] = set(each['Ec2InstanceId'] for each in batch)
+            allowed[None] = online_count - min_in_service
+
+        limited_batch = []
+        blocked = set()
+        for each in batch:
+            affected = [name for name in in_service if each['Ec2InstanceId'] in in_service[name]]
+            full = [name for name in affected if allowed[name] <= 0]
+            if full:
+                blocked.update(full)
                 continue
+            for name in affected:
+                allowed[name] -= 1
+            limited_batch.append(each)
 
-            hostname = each['Hostname']
-            instance_id = each['InstanceId']
-            ec2_instance_id = each['Ec2InstanceId']
+        if len(limited_batch) == 0:
+            where = " in ELB(s) {0}".format(", ".join(sorted(blocked))) if load_balancer_members else ""
+            log("Deploying to {0} would leave fewer than {1} instance(s) in service{2}.  Aborting".format(batch[0]['Hostname'], min_in_service, where))
+            sys.exit(1)
 
-            self._deploy_to(InstanceIds=[instance_id], Name=hostname, Comment=comment, LoadBalancerName=load_balancer_name, Ec2InstanceId=ec2_instance_id, CustomJson=custom_json)
+        deferred = [each for each in batch if each not in limited_batch]
+        if deferred:
+            log("Deferring {0} to keep at least {1} instance(s) in service".format(", ".join(each['Hostname'] for each in deferred), min_in_service))
+            pending[0:0] = deferred
+        return limited_batch
 
-    def instances_at_once(self, host_names, comment):
+    def instances_at_once(self, host_names, comment, custom_json='{}'):
         all_instances = self._make_api_call('opsworks', 'describe_instances', StackId=self.stack_id)
 
-        deployment_instance_ids = []
+        deployment_instances = []
         for each in all_instances['Instances']:
             if each['Status'] == 'online' and each['Hostname'] in host_names:
-                deployment_instance_ids.append(each['InstanceId'])
+                deployment_instances.append(each)
+
+        deployment_instance_ids = [each['InstanceId'] for each in self._stale_instances(deployment_instances)]
+        if not deployment_instance_ids:
+            log("No instances left to deploy to")
+            return
+        self._deploy_to(InstanceIds=deployment_instance_ids, Name=", ".join(host_names), Comment=comment, CustomJson=custom_json)
+
+    def post_elb_registration(self, hostname, load_balancer_name, ec2_instance_id):
+        """
+        Wait for a newly registered instance to pass the ELB health check.
+        The instance is given (HealthyThreshold + 2) * Interval seconds to come InService.
+        :return: True if the instance is InService, otherwise False
+        """
+        health_check = self._get_elb_health_check(load_balancer_name)
+        instance_healthy_wait = ((health_check['HealthyThreshold'] + 2) * health_check['Interval'])
+        log("Added {0} to ELB {1}.  Waiting up to {2} seconds for it to be online".format(hostname, load_balancer_name, instance_healthy_wait))
 
-        self._deploy_to(InstanceIds=deployment_instance_ids, Name=", ".join(host_names), Comment=comment)
+        start_time = CLOCK.time()
+        state = self._health_poller(load_balancer_name).wait(ec2_instance_id, instance_healthy_wait)
+        if state is None:
+            log("{0} is still not InService in ELB {1} after {2} seconds".format(hostname, load_balancer_name, instance_healthy_wait))
+            return False
 
-    def post_elb_registration(self, hostname, load_balancer_name):
-        describe_result = self._make_api_call('elb', 'describe_load_balancers', LoadBalancerNames=[load_balancer_name])
-        healthy_threshold = describe_result['LoadBalancerDescriptions'][0]['HealthCheck']['HealthyThreshold']
-        interval = describe_result['LoadBalancerDescriptions'][0]['HealthCheck']['Interval']
+        if state['State'] != 'InService':
+            log("{0} will not come InService in ELB {1} ({2} - {3})".format(hostname, load_balancer_name, state['ReasonCode'], state['Description']))
+            return False
 
-        instance_healthy_wait = ((healthy_threshold + 2) * interval)
-        log("Added {0} to ELB {1}.  Sleeping for {2} seconds for it to be online".format(hostname, load_balancer_name, instance_healthy_wait))
-        time.sleep(instance_healthy_wait)
+        log("{0} is InService in ELB {1} after {2:.0f} seconds".format(hostname, load_balancer_name, CLOCK.time() - start_time))
+        return True
 
-    def _get_opsworks_elb_name(self):
+    def _get_elb_health_check(self, load_balancer_name):
+        describe_result = self._describe_cached('elb', 'describe_load_balancers', LoadBalancerNames=[load_balancer_name])
+        return describe_result['LoadBalancerDescriptions'][0]['HealthCheck']
+
+    def _health_poller(self, load_balancer_name):
         """
-        Get an OpsWorks ELB Name of the layer id in the stack if is associated with the layer
-        :return: Elastic Load Balancer name if associated with the layer, otherwise None
+        Poller shared by every instance registering with the load balancer, so the health of
+        all of them is checked with a single describe_instance_health call.
         """
-        elbs = self._make_api_call('opsworks', 'describe_elastic_load_balancers', LayerIds=[self.layer_id])
-        if len(elbs['ElasticLoadBalancers']) > 0:
-            return elbs['ElasticLoadBalancers'][0]['ElasticLoadBalancerName']
-        else:
-            return None
+        return HEALTH_POLLERS.get((self.service_endpoints['elb'], load_balancer_name),
+                                  lambda: self._create_health_poller(load_balancer_name))
+
+    def _create_health_poller(self, load_balancer_name):
+        def fetch(instance_ids):
+            instance_health = self._make_api_call('elb', 'describe_instance_health',
+                                                  LoadBalancerName=load_balancer_name,
+                                                  Instances=[{'InstanceId': each} for each in instance_ids])
+            return dict((each['InstanceId'], each) for each in instance_health['InstanceStates'])
+
+        def on_status(instance_id, state):
+            status_detail = ""
+            if state['State'] != 'InService':
+                status_detail = " ({0} - {1})".format(state['ReasonCode'], state['Description'])
+            log("Current state of {0} in ELB {1} is {2}{3}".format(instance_id, load_balancer_name, state['State'], status_detail))
+
+        def is_done(state):
+            return state['State'] == 'InService' or self._is_terminal_health(state)
+
+        interval = self._get_elb_health_check(load_balancer_name)['Interval']
+        return StatusPoller(fetch, is_done, on_status, min_delay=2, max_delay=interval)
+
+    @staticmethod
+    def _is_terminal_health(state):
+        if state['State'] != 'OutOfService' or state.get('ReasonCode') != 'Instance':
+            return False
+        return any(reason in state.get('Description', '') for reason in TERMINAL_HEALTH_REASONS)
+
+    def _get_load_balancer_names(self):
+        """
+        The load balancers instances of the layer are taken out of while deploying: those attached
+        to the layer in OpsWorks, those given by name and those matching all load_balancer_tags.
+        :return: list of Elastic Load Balancer names
+        """
+        names = self._get_opsworks_elb_names() + list(self.load_balancer_names)
+        if self.load_balancer_tags:
+            names.extend(self._find_tagged_load_balancers(self.load_balancer_tags))
+
+        unique_names = []
+        for each in names:
+            if each not in unique_names:
+                unique_names.append(each)
+        return unique_names
+
+    def _get_load_balancer_members(self, load_balancer_names):
+        """
+        :return: dict of load balancer name -> set of EC2 instance ids registered with it
+        """
+        members = {}
+        for start in range(0, len(load_balancer_names), 20):
+            descriptions = self._make_api_call('elb', 'describe_load_balancers',
+                                               LoadBalancerNames=load_balancer_names[start:start + 20])['LoadBalancerDescriptions']
+            for each in descriptions:
+                members[each['LoadBalancerName']] = set(instance['InstanceId'] for instance in each.get('Instances', []))
+        return members
+
+    def _get_opsworks_elb_names(self):
+        """
+        Get the names of the OpsWorks ELBs associated with the layer
+        :return: list of Elastic Load Balancer names, empty if none is associated with the layer
+        """
+        elbs = self._describe_cached('opsworks', 'describe_elastic_load_balancers', LayerIds=[self.layer_id])
+        return [each['ElasticLoadBalancerName'] for each in elbs['ElasticLoadBalancers']]
+
+    def _find_tagged_load_balancers(self, tags):
+        """
+        Find the load balancers having all the tags, reading tags for up to 20 load balancers per call.
+        :param tags: dict of tag key -> value
+        """
+        names = []
+        marker = None
+        while True:
+            arguments = {'Marker': marker} if marker else {}
+            result = self._make_api_call('elb', 'describe_load_balancers', **arguments)
+            names.extend(each['LoadBalancerName'] for each in result['LoadBalancerDescriptions'])
+            marker = result.get('NextMarker')
+            if not marker:
+                break
+
+        tagged = []
+        for start in range(0, len(names), 20):
+            descriptions = self._make_api_call('elb', 'describe_tags', LoadBalancerNames=names[start:start + 20])['TagDescriptions']
+            for each in descriptions:
+                elb_tags = dict((tag['Key'], tag.get('Value')) for tag in each.get('Tags', []))
+                # the builtin all() is shadowed by the `all` command below
+                if not [key for key, value in tags.items() if elb_tags.get(key) != value]:
+                    tagged.append(each['LoadBalancerName'])
+
+        if not tagged:
+            log("No ELB found with tags {0}".format(", ".join("{0}={1}".format(key, value) for key, value in sorted(tags.items()))))
+        return tagged
 
     def _deploy_to(self, **kwargs):
+        with current_metrics().span('instance', instance=kwargs['Name']):
+            self._run_pre_deployment_hooks(**kwargs)
+            self._run_deployment(**kwargs)
+            self._run_post_deployment_hooks(**kwargs)
+
+    def _run_pre_deployment_hooks(self, **kwargs):
+        if self._journal_state(**kwargs).get('state') in ('deregistered', 'deploying', 'deployed'):
+            log("{0} was already taken out of service by a previous run".format(kwargs['Name']))
+            return
+
+        # recorded before the ELB drain, so an interruption while draining still leaves the load balancers to put the instance back into
+        self._journal_update('deregistering', **kwargs)
         for pre_deploy in self.pre_deployment_hooks:
             pre_deploy(**kwargs)
+        self._journal_update('deregistered', **kwargs)
+
+    def _run_deployment(self, **kwargs):
+        journal_state = self._journal_state(**kwargs)
+        if journal_state.get('state') == 'deployed':
+            log("{0} was already deployed to by a previous run".format(kwargs['Name']))
+            return
+
+        with current_metrics().span('deployment', instance=kwargs['Name'], command=self.command) as span:
+            deployment_id = None
+            if journal_state.get('state') == 'deploying':
+                deployment_id = self._reattach_deployment(journal_state['deployment_id'], kwargs['Name'])
 
-        arguments = self._create_deployment_arguments(kwargs['InstanceIds'], kwargs['Comment'], kwargs['CustomJson'])
-        deployment = self._make_api_call('opsworks', 'create_deployment', **arguments)
+            if deployment_id is None:
+                arguments = self._create_deployment_arguments(kwargs['InstanceIds'], kwargs['Comment'], kwargs['CustomJson'])
+                deployment = self._make_api_call('opsworks', 'create_deployment', **arguments)
 
-        deployment_id = deployment['DeploymentId']
-        log("Deployment {0} to {1} requested - command: {2}".format(deployment_id, kwargs['Name'], self.command))
+                deployment_id = deployment['DeploymentId']
+                log("Deployment {0} to {1} requested - command: {2}".format(deployment_id, kwargs['Name'], self.command))
+                self._journal_update('deploying', deployment_id=deployment_id, **kwargs)
 
-        self._poll_deployment_complete(deployment_id)
+            span['deployment_id'] = deployment_id
+            self._poll_deployment_complete(deployment_id)
+        self._journal_update('deployed', **kwargs)
 
+    def _reattach_deployment(self, deployment_id, name):
+        """
+        :return: deployment_id if the deployment started by a previous run is running or succeeded, otherwise None
+        """
+        deployments = self._make_api_call('opsworks', 'describe_deployments', DeploymentIds=[deployment_id])['Deployments']
+        if deployments and deployments[0]['Status'] != 'failed':
+            log("Reattaching to deployment {0} to {1} started by a previous run".format(deployment_id, name))
+            return deployment_id
+
+        log("Deployment {0} to {1} started by a previous run failed, deploying again".format(deployment_id, name))
+        return None
+
+    def _run_post_deployment_hooks(self, **kwargs):
         for post_deploy in self.post_deployment_hooks:
             post_deploy(**kwargs)
+        self._journal_update('completed', **kwargs)
+
+    def _journal_state(self, **kwargs):
+        if self.journal is None:
+            return {}
+        return self.journal.state(",".join(kwargs['InstanceIds']))
+
+    def _journal_update(self, state, deployment_id=None, **kwargs):
+        if self.journal is None:
+            return
+        details = {'hostname': kwargs['Name']}
+        if 'LoadBalancerNames' in kwargs:
+            details['load_balancers'] = kwargs['LoadBalancerNames']
+        if deployment_id is not None:
+            details['deployment_id'] = deployment_id
+        self.journal.update(",".join(kwargs['InstanceIds']), state, **details)
 
     def _create_deployment_arguments(self, instance_ids, comment, custom_json):
         raise NotImplemented('Method must be implemented in child class')
 
-    def _poll_deployment_complete(self, deployment_id):
-        start_time = time.time()
-        while True:
-            deployment_status = self._make_api_call('opsworks', 'describe_deployments', DeploymentIds=[deployment_id])
+    @property
+    def deployment_poller(self):
+        """
+        Poller shared by every operation using the same OpsWorks region, so all outstanding
+        deployments are checked with a single describe_deployments call.
+        """
+        return DEPLOYMENT_POLLERS.get(self.service_endpoints['opsworks'], self._create_deployment_poller)
 
-            for each in deployment_status['Deployments']:
-                if each['DeploymentId'] == deployment_id:
-                    if each['Status'] == 'successful':
-                        log("Deployment {0} completed successfully at {1} after {2} seconds".format(deployment_id, each['CompletedAt'], self._get_deployment_duration(each).seconds))
-                        return
+    def _create_deployment_poller(self):
+        def fetch(deployment_ids):
+            deployment_status = self._make_api_call('opsworks', 'describe_deployments', DeploymentIds=deployment_ids)
+            return dict((each['DeploymentId'], each) for each in deployment_status['Deployments'])
 
-                    if each['Status'] == 'failed':
-                        log("Deployment {0} failed in {1} seconds".format(deployment_id, self._get_deployment_duration(each).seconds))
-                        sys.exit(1)
+        def on_status(deployment_id, deployment):
+            if deployment['Status'] not in ('successful', 'failed'):
+                log("Deployment {0} is currently {1}".format(deployment_id, deployment['Status']))
 
-                    log("Deployment {0} is currently {1}".format(deployment_id, each['Status']))
-                    continue
+        return StatusPoller(fetch, lambda deployment: deployment['Status'] in ('successful', 'failed'), on_status)
 
-            elapsed_time = time.time() - start_time
-            if self.deploy_timeout is not None and elapsed_time > self.deploy_timeout:
-                log("Deployment {0} has exceeded the timeout of {1} seconds.  Aborting".format(deployment_id, self.deploy_timeout))
-                sys.exit(1)
-            time.sleep(20)
+    def _poll_deployment_complete(self, deployment_id):
+        deployment = self.deployment_poller.wait(deployment_id, self.deploy_timeout)
+
+        if deployment is None:
+            log("Deployment {0} has exceeded the timeout of {1} seconds.  Aborting".format(deployment_id, self.deploy_timeout))
+            sys.exit(1)
+
+        if deployment['Status'] == 'failed':
+            log("Deployment {0} failed in {1} seconds".format(deployment_id, self._get_deployment_duration(deployment).seconds))
+            sys.exit(1)
+
+        log("Deployment {0} completed successfully at {1} after {2} seconds".format(deployment_id, deployment['CompletedAt'], self._get_deployment_duration(deployment).seconds))
 
     @staticmethod
     def _get_deployment_duration(deployment_status):
@@ -191,63 +1190,140 @@ class Operation(object):
         return completed_at - started_at
 
     def _add_instance_to_elb(self, **kwargs):
-        self._make_api_call('elb', 'register_instances_with_load_balancer',
-                            LoadBalancerName=kwargs['LoadBalancerName'],
-                            Instances=[{'InstanceId': kwargs['Ec2InstanceId']}])
+        """
+        Register the instance with all its load balancers and wait for it to pass all their health checks.
+        """
+        if not kwargs['LoadBalancerNames']:
+            return
+        healthy = {}
 
-        self.post_elb_registration(kwargs['Name'], kwargs['LoadBalancerName'])
+        def register(load_balancer_name):
+            self._elb_batcher(load_balancer_name, 'register_instances_with_load_balancer').submit(kwargs['Ec2InstanceId'])
+            healthy[load_balancer_name] = self.post_elb_registration(kwargs['Name'], load_balancer_name, kwargs['Ec2InstanceId'])
 
-        if not self._is_instance_healthy(kwargs['LoadBalancerName'], kwargs['Ec2InstanceId']):
-            log("Instance {0} did not come online after deploy. Aborting remaining deployment".format(kwargs['Name']))
+        with current_metrics().span('health', instance=kwargs['Name'], ec2_instance_id=kwargs['Ec2InstanceId']):
+            run_concurrently(register, kwargs['LoadBalancerNames'])
+
+        unhealthy = [each for each in kwargs['LoadBalancerNames'] if not healthy.get(each)]
+        if unhealthy:
+            log("Instance {0} did not come online in ELB(s) {1} after deploy. Aborting remaining deployment".format(kwargs['Name'], ", ".join(unhealthy)))
             sys.exit(1)
 
     def _remove_instance_from_elb(self, **kwargs):
-        deregister_response = self._make_api_call('elb', 'deregister_instances_from_load_balancer',
-                                                  LoadBalancerName=kwargs['LoadBalancerName'],
-                                                  Instances=[{'InstanceId': kwargs['Ec2InstanceId']}])
-        log("Removed {0} from ELB {1}. There are still {2} instance(s) online".format(kwargs['Name'], kwargs['LoadBalancerName'], len(deregister_response['Instances'])))
+        """
+        Deregister the instance from all its load balancers at once, so draining takes as long as
+        the longest draining timeout rather than the sum of them.
+        """
+        if not kwargs['LoadBalancerNames']:
+            log("{0} is not registered with any of the ELBs".format(kwargs['Name']))
+            return
+
+        def deregister(load_balancer_name):
+            deregister_response = self._elb_batcher(load_balancer_name, 'deregister_instances_from_load_balancer').submit(kwargs['Ec2InstanceId'])
+            log("Removed {0} from ELB {1}. There are still {2} instance(s) online".format(kwargs['Name'], load_balancer_name, len(deregister_response['Instances'])))
+            self._wait_for_elb(load_balancer_name)
+
+        with current_metrics().span('drain', instance=kwargs['Name'], ec2_instance_id=kwargs['Ec2InstanceId']):
+            run_concurrently(deregister, kwargs['LoadBalancerNames'])
+
+    def _elb_batcher(self, load_balancer_name, api_operation):
+        """
+        Batcher shared by every instance (de)registering with the load balancer, so instances
+        finishing a step together are sent in one call.
+        """
+        def create():
+            return CallBatcher(lambda ec2_instance_ids: self._make_api_call(
+                'elb', api_operation, LoadBalancerName=load_balancer_name,
+                Instances=[{'InstanceId': each} for each in sorted(set(ec2_instance_ids))]))
 
-        self._wait_for_elb(kwargs['LoadBalancerName'])
+        return ELB_BATCHERS.get((self.service_endpoints['elb'], load_balancer_name, api_operation), create)
 
     def _wait_for_elb(self, load_balancer_name):
-        elb_attributes = self._make_api_call('elb', 'describe_load_balancer_attributes',
-                                             LoadBalancerName=load_balancer_name)
+        elb_attributes = self._describe_cached('elb', 'describe_load_balancer_attributes',
+                                               LoadBalancerName=load_balancer_name)
         if 'ConnectionDraining' in elb_attributes['LoadBalancerAttributes']:
             connection_draining = elb_attributes['LoadBalancerAttributes']['ConnectionDraining']
             if connection_draining['Enabled']:
-                log("Connection Draining enabled - sleeping for {0} seconds".format(connection_draining['Timeout']))
-                time.sleep(connection_draining['Timeout'])
+                log("Connection Draining enabled on ELB {0} - sleeping for {1} seconds".format(load_balancer_name, connection_draining['Timeout']))
+                CLOCK.sleep(connection_draining['Timeout'])
                 return
 
-        log("Connection Draining not enabled - sleeping for 20 seconds")
-        time.sleep(20)
-
-    def _is_instance_healthy(self, load_balancer_name, instance_id):
-        instance_health = self._make_api_call('elb', 'describe_instance_health',
-                                              LoadBalancerName=load_balancer_name,
-                                              Instances=[{'InstanceId': instance_id}])
+        log("Connection Draining not enabled on ELB {0} - sleeping for 20 seconds".format(load_balancer_name))
+        CLOCK.sleep(20)
 
-        for each in instance_health['InstanceStates']:
-            if each['InstanceId'] == instance_id:
-                status_detail = ""
-                if each['State'] != 'InService':
-                    status_detail = " ({0} - {1})".format(each['ReasonCode'], each['Description'])
-                log("Current instance state is {0}{1}".format(each['State'], status_detail))
-                return each['State'] == 'InService'
-
-        return False
+    def _in_service_instances(self, load_balancer_name):
+        instance_health = self._make_api_call('elb', 'describe_instance_health', LoadBalancerName=load_balancer_name)
+        return set(each['InstanceId'] for each in instance_health['InstanceStates'] if each['State'] == 'InService')
 
     def _make_api_call(self, service_name, api_operation, **kwargs):
         """
         Make an API call using botocore for the given service and api operation.
+        Calls are rate limited per service and region, and throttled, transient or connection failures
+        are retried with exponential backoff and jitter.  Non idempotent calls are only retried when
+        throttled or when the connection could not be made, as they may have succeeded otherwise.
+        Every call is recorded as an api_call span.
         :param service_name: AWS Service name (all lowercase)
         :param api_operation: Operation name to perform
         :param kwargs: Any additional arguments to be passed to the service call
         :return: Returns the data from the call.
         """
         service_endpoint = self.service_endpoints[service_name]
-        service = self.session.create_client(service_name, service_endpoint)
-        return getattr(service, api_operation)(**kwargs)
+        service = self.clients.get_client(service_name, service_endpoint)
+        rate_limiter = self._rate_limiter(service_name)
+
+        with current_metrics().span('api_call', service=service_name, region=service_endpoint, operation=api_operation, rate_limit_wait=0.0) as span:
+            attempt = 1
+            while True:
+                span['attempts'] = attempt
+                span['rate_limit_wait'] += rate_limiter.acquire()
+                try:
+                    result = getattr(service, api_operation)(**kwargs)
+                except ClientError as e:
+                    error_code = e.response.get('Error', {}).get('Code')
+                    status_code = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+                    span['error'] = error_code
+                    if error_code in THROTTLING_ERRORS:
+                        rate_limiter.throttled()
+                    elif api_operation in NON_IDEMPOTENT_OPERATIONS:
+                        raise
+                    elif error_code not in TRANSIENT_ERRORS and status_code < 500:
+                        raise
+                    if attempt >= MAX_API_ATTEMPTS:
+                        raise
+                    reason = error_code
+                except EndpointConnectionError as e:
+                    span['error'] = 'EndpointConnectionError'
+                    if attempt >= MAX_API_ATTEMPTS:
+                        raise
+                    reason = str(e)
+                except CONNECTION_ERRORS as e:
+                    span['error'] = type(e).__name__
+                    if api_operation in NON_IDEMPOTENT_OPERATIONS or attempt >= MAX_API_ATTEMPTS:
+                        raise
+                    reason = str(e)
+                else:
+                    rate_limiter.succeeded()
+                    return result
+
+                delay = random.uniform(0, min(30, 0.5 * 2 ** attempt))
+                log("{0}.{1} failed ({2}) - retrying in {3:.1f} seconds (attempt {4} of {5})".format(service_name, api_operation, reason, delay, attempt, MAX_API_ATTEMPTS))
+                CLOCK.sleep(delay)
+                attempt += 1
+
+    def _rate_limiter(self, service_name):
+        """
+        Rate limiter shared by every operation calling the service in the same region.
+        """
+        return RATE_LIMITERS.get((service_name, self.service_endpoints[service_name]),
+                                 lambda: RateLimiter(self.api_rates.get(service_name, 10.0)))
+
+    def _describe_cached(self, service_name, api_operation, **kwargs):
+        """
+        Same as _make_api_call, but the result is shared through the metadata cache.
+        Only use for describe calls whose result is stable for the duration of a run.
+        """
+        key = (service_name, self.service_endpoints[service_name], api_operation, json.dumps(kwargs, sort_keys=True))
+        return self.metadata.get(key, lambda: self._make_api_call(service_name, api_operation, **kwargs))
 
 
 class Update(Operation):
@@ -257,7 +1333,8 @@ class Update(Operation):
     def __init__(self, context):
         self.allow_reboot = False
         self.amazon_linux_release = None
-        self.reboot_delay = 300
+        self.reboot_timeout = 600
+        self.reboot_detection_window = 60
 
         super(Update, self).__init__(context)
         self.post_deployment_hooks.append(self.wait_for_reboot)
@@ -268,11 +1345,110 @@ class Update(Operation):
 
     def wait_for_reboot(self, **kwargs):
         """
-        Additional buffer when performing updates
+        Wait for instances rebooting after the update to come back online.  Runs before the
+        instances are registered with the ELB again, so the ELB health check follows.
         """
         if self.allow_reboot:
-            log("Sleeping {0} seconds to allow {1} to reboot (if required)".format(self.reboot_delay, kwargs['Name']))
-            time.sleep(self.reboot_delay)
+            names = {}
+            if len(kwargs['InstanceIds']) == 1:
+                names[kwargs['InstanceIds'][0]] = kwargs['Name']
+            with current_metrics().span('reboot_wait', instance=kwargs['Name']):
+                run_concurrently(lambda instance_id: self._wait_for_instance_reboot(instance_id, names.get(instance_id, instance_id)),
+                                 kwargs['InstanceIds'])
+
+    def _wait_for_instance_reboot(self, instance_id, name):
+        """
+        Watch the OpsWorks status and EC2 state of the instance for reboot_detection_window seconds.
+        If it reboots, wait until it is online again, aborting if that takes longer than
+        reboot_timeout seconds in total or the instance will not come back.
+        """
+        start_time = CLOCK.time()
+        poller = self._reboot_poller()
+        status = poller.wait(('rebooting', instance_id), self.reboot_detection_window)
+        if status is None:
+            log("{0} did not reboot within {1} seconds".format(name, self.reboot_detection_window))
+            return
+
+        name = status['Hostname']
+        log("{0} is rebooting ({1})".format(name, self._describe_reboot_status(status)))
+        remaining = max(0, self.reboot_timeout - (CLOCK.time() - start_time))
+        status = poller.wait(('recovered', instance_id), remaining)
+        if status is None:
+            log("{0} is still not back online {1} seconds after the update.  Aborting".format(name, self.reboot_timeout))
+            sys.exit(1)
+
+        if not self._is_back_online(status):
+            log("{0} will not come back online after rebooting ({1}).  Aborting".format(name, self._describe_reboot_status(status)))
+            sys.exit(1)
+
+        log("{0} is back online {1:.0f} seconds after the update".format(name, CLOCK.time() - start_time))
+
+    def _reboot_poller(self):
+        """
+        Poller shared by every operation using the same regions, so the status of all instances
+        is checked with one OpsWorks and one EC2 call per round.
+        """
+        return REBOOT_POLLERS.get((self.service_endpoints['opsworks'], self.service_endpoints['ec2']), self._create_reboot_poller)
+
+    def _create_reboot_poller(self):
+        ec2_access = {'denied': False}
+
+        def fetch(keys):
+            instance_ids = list(set(instance_id for _, instance_id in keys))
+            instances = self._make_api_call('opsworks', 'describe_instances', InstanceIds=instance_ids)['Instances']
+            ec2_ids = [each['Ec2InstanceId'] for each in instances if each.get('Ec2InstanceId')]
+
+            ec2_statuses = {}
+            if ec2_ids and not ec2_access['denied']:
+                try:
+                    instance_statuses = self._make_api_call('ec2', 'describe_instance_status', InstanceIds=ec2_ids, IncludeAllInstances=True)
+                    ec2_statuses = dict((each['InstanceId'], each) for each in instance_statuses['InstanceStatuses'])
+                except ClientError as e:
+                    if e.response.get('Error', {}).get('Code') not in ('UnauthorizedOperation', 'AccessDenied'):
+                        raise
+                    log("Not allowed to call ec2.describe_instance_status, detecting reboots from the OpsWorks status only")
+                    ec2_access['denied'] = True
+
+            statuses = {}
+            for each in instances:
+                ec2_status = ec2_statuses.get(each.get('Ec2InstanceId'), {})
+                status = {
+                    'Hostname': each['Hostname'],
+                    'Status': each['Status'],
+                    'Ec2State': ec2_status.get('InstanceState', {}).get('Name'),
+                    'Ec2Status': ec2_status.get('InstanceStatus', {}).get('Status')
+                }
+                for phase in ('rebooting', 'recovered'):
+                    if (phase, each['InstanceId']) in keys:
+                        statuses[(phase, each['InstanceId'])] = dict(status, Phase=phase)
+            return statuses
+
+        def is_done(status):
+            if status['Phase'] == 'rebooting':
+                return not self._is_back_online(status)
+            return self._is_back_online(status) or self._has_failed(status)
+
+        def on_status(key, status):
+            if status['Phase'] == 'recovered':
+                log("Current state of {0} is {1}".format(status['Hostname'], self._describe_reboot_status(status)))
+
+        return StatusPoller(fetch, is_done, on_status, min_delay=2, max_delay=10)
+
+    @staticmethod
+    def _is_back_online(status):
+        return (status['Status'] == 'online' and status['Ec2State'] in (None, 'running') and
+                status['Ec2Status'] not in ('initializing', 'impaired'))
+
+    @staticmethod
+    def _has_failed(status):
+        return status['Status'] in FAILED_OPSWORKS_STATUSES or status['Ec2State'] in FAILED_EC2_STATES
+
+    @staticmethod
+    def _describe_reboot_status(status):
+        description = "OpsWorks status {0}".format(status['Status'])
+        if status['Ec2State'] is not None:
+            description += ", EC2 state {0}, status checks {1}".format(status['Ec2State'], status['Ec2Status'])
+        return description
 
     def _create_deployment_arguments(self, instance_ids, comment, custom_json):
         parsed_custom_json = json.loads(custom_json)
@@ -300,7 +1476,9 @@ class Deploy(Operation):
     """
     def __init__(self, context):
         self.application_name = None
-        self._application_id = None
+        self.incremental = False
+        self._application = None
+        self._revision = None
 
         super(Deploy, self).__init__(context)
 
@@ -309,65 +1487,604 @@ class Deploy(Operation):
         return 'deploy'
 
     @property
-    def application_id(self):
-        if self._application_id is None:
-            applications = self._make_api_call('opsworks', 'describe_apps', StackId=self.stack_id)
+    def application(self):
+        if self._application is None:
+            applications = self._describe_cached('opsworks', 'describe_apps', StackId=self.stack_id)
             application_names = [each['Shortname'] for each in applications['Apps']]
             for each in applications['Apps']:
                 if each['Shortname'] == self.application_name:
-                    self._application_id = each['AppId']
+                    self._application = each
                     break
 
-            if self._application_id is None:
+            if self._application is None:
                 log("Application {0} not found in stack {1}.  Applications found: {2}.  Aborting".format(self.application_name, self.stack_name, application_names))
                 sys.exit(1)
 
-        return self._application_id
+        return self._application
+
+    @property
+    def application_id(self):
+        return self.application['AppId']
+
+    @property
+    def revision(self):
+        """
+        The application source being deployed.  It is recorded in the custom JSON of every
+        deployment so later runs can tell which instances already have it.  Read once per
+        operation, as the cached application may predate a change of its source.
+        """
+        if self._revision is None:
+            application = self._make_api_call('opsworks', 'describe_apps', AppIds=[self.application_id])['Apps'][0]
+            source = application.get('AppSource', {})
+            self._revision = "{0}#{1}".format(source.get('Url', ''), source.get('Revision') or '')
+        return self._revision
+
+    @property
+    def revision_is_pinned(self):
+        """
+        Whether the application source revision always names the same code.  A branch (or no
+        revision at all) can get new commits without the recorded revision changing.
+        """
+        return PINNED_REVISION_PATTERN.match(self.revision.rpartition('#')[2]) is not None
+
+    def _stale_instances(self, instances):
+        """
+        In incremental mode, leave out the instances whose most recent deployment of the
+        application successfully deployed the current revision.
+        """
+        if not self.incremental or not instances:
+            return list(instances)
+        if not self.revision_is_pinned:
+            log("Application revision {0} is not a commit SHA or version tag, so up to date instances cannot be told apart.  "
+                "Deploying to all instances".format(self.revision))
+            return list(instances)
+
+        current = self._instances_at_revision(set(each['InstanceId'] for each in instances))
+        skipped = [each['Hostname'] for each in instances if each['InstanceId'] in current]
+        if skipped:
+            log("Skipping {0} instance(s) already at revision {1}: {2}".format(len(skipped), self.revision, ", ".join(skipped)))
+        return [each for each in instances if each['InstanceId'] not in current]
+
+    def _instances_at_revision(self, instance_ids):
+        """
+        Find the instances whose latest deployment of the application deployed the current revision.
+        All deployments of the application are read with one call, and the per-instance results of
+        a failed deployment with one call per deployment.
+        """
+        deployments = self._make_api_call('opsworks', 'describe_deployments', AppId=self.application_id)['Deployments']
+        latest = {}
+        for deployment in sorted(deployments, key=lambda each: arrow.get(each['CreatedAt']), reverse=True):
+            for instance_id in deployment.get('InstanceIds', []):
+                if instance_id in instance_ids:
+                    latest.setdefault(instance_id, deployment)
+
+        current = set()
+        succeeded_on = {}
+        for instance_id, deployment in latest.items():
+            if deployment['Command']['Name'] != self.command or self._deployed_revision(deployment) != self.revision:
+                continue
+
+            if deployment['Status'] == 'successful':
+                current.add(instance_id)
+            elif deployment['Status'] == 'failed':
+                deployment_id = deployment['DeploymentId']
+                if deployment_id not in succeeded_on:
+                    commands = self._make_api_call('opsworks', 'describe_commands', DeploymentId=deployment_id)['Commands']
+                    succeeded_on[deployment_id] = set(each['InstanceId'] for each in commands if each['Status'] == 'successful')
+                if instance_id in succeeded_on[deployment_id]:
+                    current.add(instance_id)
+        return current
+
+    @staticmethod
+    def _deployed_revision(deployment):
+        try:
+            return json.loads(deployment.get('CustomJson') or '{}').get(REVISION_JSON_KEY)
+        except (ValueError, AttributeError):
+            return None
+
+    def journal_identity(self):
+        return dict(super(Deploy, self).journal_identity(), application=self.application_name)
 
     def _create_deployment_arguments(self, instance_ids, comment, custom_json):
+        parsed_custom_json = json.loads(custom_json)
+        parsed_custom_json[REVISION_JSON_KEY] = self.revision
+
         return {
             'StackId': self.stack_id,
             'AppId': self.application_id,
             'InstanceIds': instance_ids,
             'Command': {'Name': self.command},
             'Comment': comment,
-            'CustomJson': custom_json
+            'CustomJson': json.dumps(parsed_custom_json)
         }
 
 
+class StatusBoard(object):
+    """
+    Tracks the state of every target of a plan and renders them as a single status table.
+    """
+    def __init__(self, labels):
+        self._lock = threading.Lock()
+        self._labels = list(labels)
+        self._states = dict((label, {'state': 'pending', 'started': None, 'finished': None}) for label in self._labels)
+
+    def update(self, label, state):
+        with self._lock:
+            entry = self._states[label]
+            entry['state'] = state
+            if state == 'running':
+                entry['started'] = CLOCK.time()
+            elif state in ('succeeded', 'failed'):
+                entry['finished'] = CLOCK.time()
+
+    def failed(self):
+        with self._lock:
+            return [label for label in self._labels if self._states[label]['state'] == 'failed']
+
+    def render(self):
+        now = CLOCK.time()
+        width = max(len(label) for label in self._labels)
+        lines = []
+        with self._lock:
+            for label in self._labels:
+                entry = self._states[label]
+                elapsed = ""
+                if entry['started'] is not None:
+                    elapsed = "{0:.0f}s".format((entry['finished'] or now) - entry['started'])
+                lines.append("  {0}  {1:<9}  {2}".format(label.ljust(width), entry['state'], elapsed))
+        return lines
+
+
 def log(message):
-    click.echo("[{0}] {1}".format(arrow.utcnow().format('YYYY-MM-DD HH:mm:ss ZZ'), message))
+    prefix = getattr(LOG_CONTEXT, 'prefix', None)
+    if prefix is not None:
+        message = "[{0}] {1}".format(prefix, message)
+    line = "[{0}] {1}".format(arrow.get(CLOCK.time()).format('YYYY-MM-DD HH:mm:ss ZZ'), message)
+
+    sink = getattr(LOG_CONTEXT, 'sink', None)
+    if sink is not None:
+        sink(line)
+    else:
+        click.echo(line)
+
+
+def log_rate_limiter_summary():
+    for (service_name, region), rate_limiter in sorted(RATE_LIMITERS.items()):
+        log("API rate limiter {0} ({1}): {2}".format(service_name, region, rate_limiter.summary()))
+
+
+def log_metrics_summary():
+    for line in current_metrics().summary():
+        log(line)
+
+
+def current_metrics():
+    """
+    Metrics of the job running on this thread (see daemon), or the process wide METRICS
+    """
+    metrics = getattr(LOG_CONTEXT, 'metrics', None)
+    return metrics if metrics is not None else METRICS
+
+
+def save_log_context():
+    return dict((name, getattr(LOG_CONTEXT, name, None)) for name in LOG_CONTEXT_FIELDS)
+
+
+def restore_log_context(context):
+    for name in LOG_CONTEXT_FIELDS:
+        setattr(LOG_CONTEXT, name, context.get(name))
+
+
+def spawn(target, *args):
+    """
+    Start a daemon thread running target(*args).  The thread logs with the same prefix, to the
+    same sink and records metrics in the same place as its parent.
+    """
+    context = save_log_context()
+
+    def run():
+        restore_log_context(context)
+        target(*args)
+
+    return CLOCK.start_thread(run)
+
+
+def run_concurrently(func, items, max_workers=None):
+    """
+    Call func for every item using up to max_workers threads and wait for all of them.
+    Once a call fails no further items are started, and the first exception (including the
+    SystemExit raised when aborting) is re-raised on the calling thread.
+    :param func: function taking a single item
+    :param items: items to process
+    :param max_workers: maximum number of threads, defaults to one per item
+    """
+    items = collections.deque(items)
+    if len(items) == 1:
+        func(items.popleft())
+        return
+
+    errors = []
+
+    def worker():
+        while not errors:
+            try:
+                item = items.popleft()
+            except IndexError:
+                return
+            try:
+                func(item)
+            except BaseException as e:
+                errors.append(e)
+
+    threads = [spawn(worker) for _ in range(min(max_workers or len(items), len(items)))]
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+
+PLAN_TARGET_FIELDS = {
+    'stack': 'string', 'layer': 'string', 'application': 'string', 'command': 'string', 'strategy': 'string',
+    'opsworks_region': 'string', 'elb_region': 'string', 'comment': 'string', 'custom_json': 'string',
+    'hosts': 'list', 'exclude_hosts': 'list', 'timeout': 'int', 'batch_size': 'int', 'batch_percent': 'int',
+    'min_in_service': 'int', 'pipeline': 'bool', 'max_out_of_service': 'int', 'allow_reboot': 'bool',
+    'resume': 'bool', 'journal_file': 'string', 'incremental': 'bool', 'reboot_timeout': 'int', 'reboot_detection_window': 'int',
+    'load_balancers': 'list', 'load_balancer_tags': 'list'
+}
+PLAN_FIELD_TYPES = {'string': (str, type(u'')), 'int': (int,), 'bool': (bool,), 'list': (list,)}
+
+
+def parse_target(spec):
+    """
+    Parse a plan target given on the command line, either as a JSON object or as
+    comma separated key=value pairs (list values are separated by semicolons).
+    """
+    if spec.strip().startswith('{'):
+        return json.loads(spec)
+
+    target = {}
+    for pair in spec.split(','):
+        key, _, value = pair.partition('=')
+        key = key.strip().replace('-', '_')
+        field_type = PLAN_TARGET_FIELDS.get(key)
+        if field_type == 'int':
+            value = int(value)
+        elif field_type == 'bool':
+            value = value.lower() in ('1', 'true', 'yes')
+        elif field_type == 'list':
+            value = value.split(';')
+        target[key] = value
+    return target
+
+
+def parse_tags(tags):
+    """
+    Parse key=value strings into a dict of tags
+    """
+    parsed = {}
+    for each in tags:
+        key, _, value = each.partition('=')
+        parsed[key.strip()] = value.strip()
+    return parsed
+
+
+def load_plan(plan_file):
+    """
+    Load plan targets from a JSON or YAML (requires PyYAML) file.  The file contains either
+    a list of targets or an object with a "targets" list.
+    """
+    with open(plan_file, 'r') as plan:
+        if plan_file.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                log("PyYAML is required to read {0}.  Aborting".format(plan_file))
+                sys.exit(1)
+            content = yaml.safe_load(plan)
+        else:
+            content = json.load(plan)
+
+    if isinstance(content, dict):
+        content = content.get('targets', [])
+    return content
+
+
+def validate_target(target, opsworks_region, elb_region):
+    """
+    Check a plan target and fill in its defaults.
+    :return: the completed target
+    """
+    unknown = [key for key in target if key not in PLAN_TARGET_FIELDS]
+    if unknown:
+        log("Unknown plan target field(s) {0} in {1}.  Aborting".format(", ".join(unknown), target))
+        sys.exit(1)
+
+    target = dict(target)
+    target.setdefault('command', 'deploy' if 'application' in target else 'update')
+    target.setdefault('strategy', 'instances' if 'hosts' in target else 'rolling')
+    target.setdefault('opsworks_region', opsworks_region)
+    target.setdefault('elb_region', elb_region)
+    if isinstance(target.get('custom_json'), dict):
+        target['custom_json'] = json.dumps(target['custom_json'])
+
+    mismatched = []
+    for key, value in sorted(target.items()):
+        field_type = PLAN_TARGET_FIELDS[key]
+        if field_type == 'list' and isinstance(value, PLAN_FIELD_TYPES['string']):
+            # as on the command line, otherwise a single host name would be matched as a substring
+            target[key] = value = value.split(';')
+        # bool is a subclass of int
+        valid = isinstance(value, PLAN_FIELD_TYPES[field_type]) and isinstance(value, bool) == (field_type == 'bool')
+        if field_type == 'list':
+            valid = valid and not [each for each in value if not isinstance(each, PLAN_FIELD_TYPES['string'])]
+        if not valid:
+            mismatched.append("{0} (expected {1}, got {2!r})".format(key, field_type, value))
+    if mismatched:
+        log("Invalid plan target field(s) {0} in {1}.  Aborting".format(", ".join(mismatched), target))
+        sys.exit(1)
+
+    required = ['stack', 'hosts' if target['strategy'] == 'instances' else 'layer']
+    if target['command'] == 'deploy':
+        required.append('application')
+    missing = [key for key in required if key not in target]
+    if missing or target['command'] not in ('deploy', 'update') or target['strategy'] not in ('rolling', 'all', 'instances'):
+        log("Invalid plan target {0} (missing: {1}).  Aborting".format(target, ", ".join(missing) or "none"))
+        sys.exit(1)
+
+    target['label'] = "{0}:{1}/{2}".format(target['opsworks_region'], target['stack'], target.get('layer') or ";".join(target['hosts']))
+    return target
+
+
+def run_target(ctx, target):
+    """
+    Run a single plan target with the same Deploy/Update operations as the individual commands.
+    """
+    context = click.Context(ctx.command, obj=dict(ctx.obj, OPSWORKS_REGION=target['opsworks_region'], ELB_REGION=target['elb_region']))
+    if target['command'] == 'deploy':
+        operation = Deploy(context)
+        operation.application_name = target['application']
+        operation.incremental = target.get('incremental', False)
+    else:
+        operation = Update(context)
+        operation.allow_reboot = target.get('allow_reboot', False)
+        operation.reboot_timeout = target.get('reboot_timeout', operation.reboot_timeout)
+        operation.reboot_detection_window = target.get('reboot_detection_window', operation.reboot_detection_window)
+
+    operation.init(stack_name=target['stack'], layer_name=target.get('layer'), timeout=target.get('timeout'))
+    operation.load_balancer_names = target.get('load_balancers', [])
+    operation.load_balancer_tags = parse_tags(target.get('load_balancer_tags', []))
+    comment = target.get('comment')
+    custom_json = target.get('custom_json', '{}')
+    if target['strategy'] == 'rolling':
+        operation.journal = open_journal(operation, target.get('journal_file'), target.get('resume', False))
+        operation.layer_rolling(comment=comment, custom_json=custom_json, batch_size=target.get('batch_size', 1),
+                                batch_percent=target.get('batch_percent'), min_in_service=target.get('min_in_service'),
+                                pipeline=target.get('pipeline', False), max_out_of_service=target.get('max_out_of_service', 2))
+    elif target['strategy'] == 'all':
+        operation.layer_at_once(comment=comment, exclude_hosts=target.get('exclude_hosts'), custom_json=custom_json)
+    else:
+        operation.instances_at_once(host_names=target['hosts'], comment=comment, custom_json=custom_json)
+
+
+def run_plan(ctx, targets, max_concurrent, max_per_region, status_interval):
+    """
+    Run all targets concurrently, with at most max_concurrent targets in total and max_per_region
+    targets per OpsWorks region in flight.  A failing target does not stop the others.
+    :return: list of labels of the targets that failed
+    """
+    board = StatusBoard(target['label'] for target in targets)
+    region_slots = {}
+    for target in targets:
+        region_slots.setdefault(target['opsworks_region'], CLOCK.semaphore(max_per_region))
+
+    def run(target):
+        with region_slots[target['opsworks_region']]:
+            LOG_CONTEXT.prefix = target['label']
+            board.update(target['label'], 'running')
+            try:
+                run_target(ctx, target)
+                board.update(target['label'], 'succeeded')
+            except BaseException as e:
+                log("Target failed: {0!r}".format(e))
+                board.update(target['label'], 'failed')
+            finally:
+                LOG_CONTEXT.prefix = None
+
+    finished = CLOCK.event()
+
+    def report():
+        while not finished.wait(status_interval) and not finished.is_set():
+            log("Plan status:\n" + "\n".join(board.render()))
+
+    spawn(report)
+    try:
+        run_concurrently(run, targets, max_workers=max_concurrent)
+    finally:
+        finished.set()
+
+    log("Plan finished:\n" + "\n".join(board.render()))
+    return board.failed()
+
+
+class JobServer(object):
+    """
+    Accepts jobs (easy_deploy.py command lines sent by submit.py) on a Unix socket and runs them
+    in this process, so the botocore session, clients, rate limiters, pollers and cached
+    stack/layer/app lookups stay warm between jobs.
+
+    The client sends one JSON line {"args": [...]}.  The job's log lines are streamed back as
+    {"log": line} and the last line is {"exit_code": code}.
+    """
+    def __init__(self, socket_path, max_jobs, cache_ttl):
+        self.socket_path = socket_path
+        self.max_jobs = max_jobs
+        self.cache_ttl = cache_ttl
+
+        self._slots = CLOCK.semaphore(max_jobs)
+        self._lock = threading.Lock()
+        self._job_count = 0
+        self._active = 0
+
+    def serve_forever(self):
+        # every job records into its own Metrics, so the process wide one must not keep spans forever
+        METRICS.retain = False
+        METRICS.clear()
+        listener = self._listen()
+        log("Accepting up to {0} concurrent job(s) on {1}".format(self.max_jobs, self.socket_path))
+        try:
+            while True:
+                connection, _ = listener.accept()
+                spawn(self._handle, connection)
+        finally:
+            listener.close()
+            os.remove(self.socket_path)
+
+    def _listen(self):
+        directory = os.path.dirname(os.path.abspath(self.socket_path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        if os.path.exists(self.socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+                log("A daemon is already listening on {0}.  Aborting".format(self.socket_path))
+                sys.exit(1)
+            except socket.error:
+                os.remove(self.socket_path)
+            finally:
+                probe.close()
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        listener.listen(16)
+        return listener
+
+    def _handle(self, connection):
+        send_lock = threading.Lock()
+        disconnected = []
+
+        def send(message):
+            with send_lock:
+                if disconnected:
+                    return
+                try:
+                    connection.sendall((json.dumps(message) + "\n").encode('utf-8'))
+                except socket.error:
+                    disconnected.append(True)
+
+        with self._lock:
+            self._job_count += 1
+            job_id = self._job_count
+
+        try:
+            request = json.loads(connection.makefile('rb').readline().decode('utf-8'))
+            args = [str(each) for each in request['args']]
+        except (ValueError, KeyError, TypeError) as e:
+            send({'log': "Invalid job request: {0}".format(e)})
+            send({'exit_code': 2})
+            connection.close()
+            return
+
+        LOG_CONTEXT.prefix = "job {0}".format(job_id)
+        with self._lock:
+            queued = self._active >= self.max_jobs
+            self._active += 1
+        if queued:
+            send({'log': "Waiting for one of the {0} job slot(s) to become free".format(self.max_jobs)})
+
+        try:
+            with self._slots:
+                log("Running {0}".format(" ".join(args)))
+                METADATA_CACHE.expire(self.cache_ttl)
+                exit_code = self._run_job(args, send)
+                log("Finished with exit code {0}{1}".format(exit_code, " (client disconnected)" if disconnected else ""))
+            send({'exit_code': exit_code})
+        finally:
+            with self._lock:
+                self._active -= 1
+            connection.close()
+
+    @staticmethod
+    def _run_job(args, send):
+        """
+        Run a command line with cli, logging to the client and recording metrics for this job only.
+        :return: the exit code
+        """
+        context = save_log_context()
+        restore_log_context({'sink': lambda line: send({'log': line}), 'metrics': Metrics()})
+        try:
+            cli.main(args=args, prog_name='easy_deploy.py', obj={'DAEMON_JOB': True}, standalone_mode=False)
+            return 0
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                return e.code or 0
+            log(str(e.code))
+            return 1
+        except click.ClickException as e:
+            log(e.format_message())
+            return e.exit_code
+        except click.Abort:
+            return 1
+        except Exception as e:
+            log("Job failed: {0!r}".format(e))
+            return 1
+        finally:
+            restore_log_context(context)
 
 
 @click.group(chain=True)
 @click.option('--profile', type=click.STRING, help='Profile used to lookup credentials.')
 @click.option('--opsworks-region', type=click.STRING, default='us-east-1', help="OpsWorks region endpoint")
 @click.option('--elb-region', type=click.STRING, default='us-east-1', help="Elastic Load Balancer region endpoint")
+@click.option('--opsworks-rate', type=click.FLOAT, default=DEFAULT_API_RATES['opsworks'], help="Maximum OpsWorks API calls per second")
+@click.option('--elb-rate', type=click.FLOAT, default=DEFAULT_API_RATES['elb'], help="Maximum Elastic Load Balancer API calls per second")
+@click.option('--metrics-file', type=click.Path(dir_okay=False, writable=True), default=None, help="Append phase and API call timings to this file as JSON lines")
 @click.pass_context
-def cli(ctx, profile, opsworks_region, elb_region):
+def cli(ctx, profile, opsworks_region, elb_region, opsworks_rate, elb_rate, metrics_file):
     if profile is not None:
+        if ctx.obj.get('DAEMON_JOB'):
+            log("--profile cannot be used in daemon jobs, the daemon's credentials are used.  Aborting")
+            sys.exit(1)
         os.environ['BOTO_DEFAULT_PROFILE'] = profile
     ctx.obj['OPSWORKS_REGION'] = opsworks_region
     ctx.obj['ELB_REGION'] = elb_region
+    ctx.obj['API_RATES'] = {'opsworks': opsworks_rate, 'elb': elb_rate}
+    if not ctx.obj.get('DAEMON_JOB'):
+        # the rate limiters are shared by every job of the daemon, a job's own rate limit waits are in its metrics summary
+        ctx.call_on_close(log_rate_limiter_summary)
+    ctx.call_on_close(log_metrics_summary)
+    if metrics_file is not None:
+        metrics = current_metrics()
+        metrics.open(metrics_file)
+        ctx.call_on_close(metrics.close)
 
 
 @cli.command(help='Installs regular operating system updates and package updates')
 @click.option('--allow-reboot/--no-all-reboot', default=False, help='Allow OpsWorks to reboot instance if kernel was updated')
 @click.option('--amazon-linux-release', type=click.STRING, help='Set the Amazon Linux version, only use it when OpsWorks has support for it')
+@click.option('--reboot-timeout', type=click.INT, default=600, help='Maximum seconds for an instance to reboot and come back online')
+@click.option('--reboot-detection-window', type=click.INT, default=60, help='Seconds to watch for an instance starting to reboot after the update')
 @click.pass_context
-def update(ctx, allow_reboot, amazon_linux_release):
+def update(ctx, allow_reboot, amazon_linux_release, reboot_timeout, reboot_detection_window):
     operation = Update(ctx)
     operation.allow_reboot = allow_reboot
     operation.amazon_linux_release = amazon_linux_release
+    operation.reboot_timeout = reboot_timeout
+    operation.reboot_detection_window = reboot_detection_window
     ctx.obj['OPERATION'] = operation
 
 
 @cli.command(help='Deploys an application')
 @click.option('--application', type=click.STRING, required=True, help='OpsWorks Application')
+@click.option('--incremental/--no-incremental', default=False, help='Only deploy to instances that do not have the current application revision yet')
 @click.pass_context
-def deploy(ctx, application):
+def deploy(ctx, application, incremental):
     operation = Deploy(ctx)
     operation.application_name = application
+    operation.incremental = incremental
     ctx.obj['OPERATION'] = operation
 
 
@@ -376,7 +2093,7 @@ def deploy(ctx, application):
 @click.option('--layer-name', type=click.STRING, required=True, help='Layer to deploy application to')
 @click.option('--exclude-hosts', '-x', default=None, help='Host names to exclude from deployment (comma separated list)')
 @click.option('--comment', help='Deployment message')
-@click.option('--timeout', default=None, help='Deployment timeout')
+@click.option('--timeout', type=click.INT, default=None, help='Deployment timeout')
 @click.pass_context
 def all(ctx, stack_name, layer_name, exclude_hosts, comment, timeout):
     operation = ctx.obj['OPERATION']
@@ -391,19 +2108,34 @@ def all(ctx, stack_name, layer_name, exclude_hosts, comment, timeout):
 @click.option('--layer-name', type=click.STRING, required=True, help='Layer to deploy application to')
 @click.option('--comment', help='Deployment message')
 @click.option('--custom-json', default='{}', help='Custom Json')
-@click.option('--timeout', default=None, help='Deployment timeout')
+@click.option('--timeout', type=click.INT, default=None, help='Deployment timeout')
+@click.option('--batch-size', type=click.INT, default=1, help='Number of instances to deploy to at the same time')
+@click.option('--batch-percent', type=click.INT, default=None, help='Percentage of the layer to deploy to at the same time (overrides --batch-size)')
+@click.option('--min-in-service', type=click.INT, default=None, help='Minimum number of instances that must stay in service')
+@click.option('--pipeline/--no-pipeline', default=False, help='Start draining the next instance while the previous one is deploying')
+@click.option('--max-out-of-service', type=click.INT, default=2, help='Maximum number of instances out of service at once when pipelining')
+@click.option('--load-balancer', '-l', multiple=True, help='Additional ELB to take instances out of while deploying (can be repeated)')
+@click.option('--load-balancer-tag', multiple=True, help='Also use the ELBs having this key=value tag (can be repeated, ELBs must match all)')
+@click.option('--resume/--no-resume', default=False, help='Continue an interrupted rollout from its journal')
+@click.option('--journal-file', type=click.Path(dir_okay=False), default=None,
+              help='Journal recording the progress of the rollout (default: ~/.easy_deploy/<region>-<stack>-<layer>-<command>[-<application>].journal.json)')
 @click.pass_context
-def rolling(ctx, stack_name, layer_name, comment, custom_json, timeout):
+def rolling(ctx, stack_name, layer_name, comment, custom_json, timeout, batch_size, batch_percent, min_in_service, pipeline, max_out_of_service,
+            load_balancer, load_balancer_tag, resume, journal_file):
     operation = ctx.obj['OPERATION']
     operation.init(stack_name=stack_name, layer_name=layer_name, timeout=timeout)
-    operation.layer_rolling(comment=comment, custom_json=custom_json)
+    operation.load_balancer_names = list(load_balancer)
+    operation.load_balancer_tags = parse_tags(load_balancer_tag)
+    operation.journal = open_journal(operation, journal_file, resume)
+    operation.layer_rolling(comment=comment, custom_json=custom_json, batch_size=batch_size, batch_percent=batch_percent,
+                            min_in_service=min_in_service, pipeline=pipeline, max_out_of_service=max_out_of_service)
 
 
 @cli.command(help='Execute operation on specific hosts')
 @click.option('--stack-name', type=click.STRING, required=True, help='OpsWorks Stack name')
 @click.option('--hosts', '-H', type=click.STRING, required=True, help='Host names to deploy application to (comma separated list)')
 @click.option('--comment', help='Deployment message')
-@click.option('--timeout', default=None, help='Deployment timeout')
+@click.option('--timeout', type=click.INT, default=None, help='Deployment timeout')
 @click.pass_context
 def instances(ctx, stack_name, hosts, comment, timeout):
     operation = ctx.obj['OPERATION']
@@ -412,5 +2144,47 @@ def instances(ctx, stack_name, hosts, comment, timeout):
     operation.instances_at_once(comment=comment, host_names=hosts)
 
 
+@cli.command(help='Execute several deploy/update targets (stack, layer, application and strategy) concurrently')
+@click.option('--plan-file', type=click.Path(exists=True), default=None, help='JSON or YAML file listing the targets')
+@click.option('--target', '-t', multiple=True, help='Target as key=value pairs, e.g. stack=web,layer=api,application=myapp,strategy=rolling')
+@click.option('--max-concurrent', type=click.INT, default=4, help='Maximum number of targets running at once')
+@click.option('--max-per-region', type=click.INT, default=2, help='Maximum number of targets running at once per OpsWorks region')
+@click.option('--status-interval', type=click.INT, default=60, help='Seconds between status reports')
+@click.option('--resume/--no-resume', default=False, help='Continue interrupted rolling targets from their journals')
+@click.pass_context
+def plan(ctx, plan_file, target, max_concurrent, max_per_region, status_interval, resume):
+    targets = [parse_target(each) for each in target]
+    if plan_file is not None:
+        targets.extend(load_plan(plan_file))
+    if not targets:
+        log("No targets given, use --plan-file or --target.  Aborting")
+        sys.exit(1)
+
+    targets = [validate_target(each, ctx.obj['OPSWORKS_REGION'], ctx.obj['ELB_REGION']) for each in targets]
+    for each in targets:
+        each.setdefault('resume', resume)
+    labels = collections.defaultdict(int)
+    for each in targets:
+        labels[each['label']] += 1
+        if labels[each['label']] > 1:
+            each['label'] = "{0} #{1}".format(each['label'], labels[each['label']])
+    failed = run_plan(ctx, targets, max_concurrent, max_per_region, status_interval)
+    if failed:
+        log("{0} of {1} target(s) failed: {2}".format(len(failed), len(targets), ", ".join(failed)))
+        sys.exit(1)
+
+
+@cli.command(help='Run jobs submitted with submit.py, keeping clients and cached lookups warm between them')
+@click.option('--socket', 'socket_path', type=click.Path(dir_okay=False), default=DAEMON_SOCKET, help='Unix socket to accept jobs on')
+@click.option('--max-jobs', type=click.INT, default=4, help='Maximum number of jobs running at once, further jobs are queued')
+@click.option('--cache-ttl', type=click.INT, default=300, help='Seconds cached stack, layer, app and load balancer lookups are reused for')
+@click.pass_context
+def daemon(ctx, socket_path, max_jobs, cache_ttl):
+    if ctx.obj.get('DAEMON_JOB'):
+        log("Jobs cannot start a daemon.  Aborting")
+        sys.exit(1)
+    JobServer(socket_path, max_jobs, cache_ttl).serve_forever()
+
+
 if __name__ == '__main__':
     cli(obj={})
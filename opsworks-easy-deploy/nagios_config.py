@@ -0,0 +1,182 @@
+#!/usr/bin/python
+
+#
+# Copyright 2014 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0
+#
+# or in the "license" file accompanying this file. This file is distributed
+# on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language governing
+# permissions and limitations under the License.
+#
+
+import os
+import re
+import sys
+import shlex
+import tempfile
+import subprocess
+import click
+from botocore.exceptions import ClientError, EndpointConnectionError
+
+import easy_deploy
+from easy_deploy import Operation, log
+
+FILE_HEADER = "# {0} definitions\n#\n# Autogenerated by OpsWorks.\n\n"
+
+
+def collect_hosts(operations):
+    """
+    Build the Nagios hosts and hostgroups of the online instances in the stacks, the same way
+    opsworks-nagios/recipe-search-configure.rb does: a hostgroup per layer and per availability zone.
+    :param operations: one Operation per stack
+    :return: tuple of dict hostname -> {'hostgroups': set of hostgroup names, 'private_ip': ip}
+             and dict hostgroup name -> alias
+    """
+    hosts = {}
+    hostgroups = {}
+    for operation in operations:
+        layers = operation._make_api_call('opsworks', 'describe_layers', StackId=operation.stack_id)['Layers']
+        layer_names = dict((each['LayerId'], each['Name']) for each in layers)
+        instances = operation._make_api_call('opsworks', 'describe_instances', StackId=operation.stack_id)['Instances']
+
+        for each in instances:
+            if each['Status'] != 'online':
+                continue
+            host_hostgroups = {each['AvailabilityZone']: each['AvailabilityZone']}
+            for layer_id in each.get('LayerIds', []):
+                host_hostgroups[layer_id] = layer_names.get(layer_id, layer_id)
+            hostgroups.update(host_hostgroups)
+
+            host = hosts.setdefault(each['Hostname'], {'hostgroups': set(), 'private_ip': each.get('PrivateIp')})
+            host['hostgroups'].update(host_hostgroups)
+    return hosts, hostgroups
+
+
+def render_hostgroups(hostgroups):
+    yield FILE_HEADER.format('Hostgroup')
+    yield "define hostgroup {\n  hostgroup_name    all\n  alias             all\n}\n\n"
+    for name in sorted(hostgroups):
+        yield "define hostgroup {{\n  hostgroup_name {0}\n  alias {1}\n}}\n".format(name, hostgroups[name])
+
+
+def render_hosts(hosts, address='hostname'):
+    yield FILE_HEADER.format('Host')
+    for name in sorted(hosts):
+        host = hosts[name]
+        yield "define host {{\n  use common-host\n  address {0}\n  host_name {1}\n  hostgroups all,{2}\n}}\n".format(
+            host['private_ip'] if address == 'private_ip' else name, name, ",".join(sorted(host['hostgroups'])))
+
+
+def write_if_changed(path, chunks):
+    """
+    Write the rendered chunks to a temporary file while comparing them with the file on disk,
+    and only replace the file if the content differs.
+    :return: True if the file was replaced
+    """
+    existing = open(path, 'r') if os.path.exists(path) else None
+    changed = existing is None
+    fd, temp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'w') as temp_file:
+            for chunk in chunks:
+                temp_file.write(chunk)
+                if not changed and existing.read(len(chunk)) != chunk:
+                    changed = True
+        if not changed and existing.read(1):
+            changed = True
+
+        if not changed:
+            os.remove(temp_path)
+            return False
+
+        os.chmod(temp_path, 0o644)
+        if existing is not None:
+            stat = os.fstat(existing.fileno())
+            try:
+                os.chown(temp_path, stat.st_uid, stat.st_gid)
+            except OSError:
+                pass
+        os.rename(temp_path, path)
+        return True
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    finally:
+        if existing is not None:
+            existing.close()
+
+
+def read_host_names(path):
+    if not os.path.exists(path):
+        return set()
+    with open(path, 'r') as hosts_file:
+        return set(match.group(1) for match in (re.match(r'\s*host_name\s+(\S+)', line) for line in hosts_file) if match)
+
+
+def refresh(operations, conf_dir, address, reload_command, force_reload=False):
+    """
+    Regenerate hosts.cfg and hostgroups.cfg and reload Nagios if either changed.
+    :param force_reload: reload even if the files did not change, e.g. after a failed reload
+    :return: False if the reload failed, otherwise True
+    """
+    hosts, hostgroups = collect_hosts(operations)
+    hosts_path = os.path.join(conf_dir, 'hosts.cfg')
+    previous_hosts = read_host_names(hosts_path)
+
+    changed = write_if_changed(os.path.join(conf_dir, 'hostgroups.cfg'), render_hostgroups(hostgroups))
+    changed = write_if_changed(hosts_path, render_hosts(hosts, address)) or changed
+    if not changed and not force_reload:
+        log("Nagios configuration is up to date ({0} hosts, {1} hostgroups)".format(len(hosts), len(hostgroups)))
+        return True
+
+    added = sorted(set(hosts) - previous_hosts)
+    removed = sorted(previous_hosts - set(hosts))
+    log("Nagios configuration changed ({0} hosts, {1} hostgroups; added: {2}; removed: {3}) - running {4}".format(
+        len(hosts), len(hostgroups), ", ".join(added) or "none", ", ".join(removed) or "none", reload_command))
+    return_code = subprocess.call(shlex.split(reload_command))
+    if return_code != 0:
+        log("{0} failed with exit code {1}".format(reload_command, return_code))
+        return False
+    return True
+
+
+@click.command(help='Generate Nagios hosts.cfg and hostgroups.cfg from OpsWorks and reload Nagios when they change')
+@click.option('--stack-name', type=click.STRING, required=True, multiple=True, help='OpsWorks Stack name (can be repeated)')
+@click.option('--opsworks-region', type=click.STRING, default='us-east-1', help="OpsWorks region endpoint")
+@click.option('--conf-dir', type=click.Path(file_okay=False), default='/etc/nagios/conf.d', help='Directory to write hosts.cfg and hostgroups.cfg to')
+@click.option('--address', type=click.Choice(['hostname', 'private_ip']), default='hostname', help='Use the hostname or the private IP as host address')
+@click.option('--reload-command', default='service nagios reload', help='Command reloading Nagios')
+@click.option('--interval', type=click.INT, default=None, help='Keep running and refresh every N seconds (default: refresh once)')
+def cli(stack_name, opsworks_region, conf_dir, address, reload_command, interval):
+    context = click.Context(cli, obj={'OPSWORKS_REGION': opsworks_region, 'ELB_REGION': opsworks_region})
+    operations = []
+    for each in stack_name:
+        operation = Operation(context)
+        operation.init(stack_name=each)
+        operations.append(operation)
+
+    if interval is None:
+        if not refresh(operations, conf_dir, address, reload_command):
+            sys.exit(1)
+        return
+
+    # clients, rate limiters and stack ids stay warm between refreshes, spans of API calls are not kept
+    easy_deploy.METRICS.retain = False
+    reloaded = True
+    while True:
+        try:
+            reloaded = refresh(operations, conf_dir, address, reload_command, force_reload=not reloaded)
+        except (ClientError, EndpointConnectionError) as e:
+            log("Refresh failed: {0}".format(e))
+        easy_deploy.CLOCK.sleep(interval)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,589 @@
+#
+# Copyright 2014 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0
+#
+# or in the "license" file accompanying this file. This file is distributed
+# on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language governing
+# permissions and limitations under the License.
+#
+
+"""
+Local stand-in for the OpsWorks, Elastic Load Balancing and EC2 APIs used by easy_deploy,
+driven by a virtual clock so complete rollouts can be run in seconds.
+"""
+
+import json
+import random
+import threading
+import collections
+import arrow
+import click
+
+import easy_deploy
+
+# 2014-10-22 00:00:00 UTC, so simulated log lines look like real ones
+SIMULATION_EPOCH = 1413936000.0
+
+
+class SimulationDeadlock(Exception):
+    pass
+
+
+class VirtualClock(object):
+    """
+    Clock for running threaded code deterministically in virtual time.
+
+    Only one of the threads taking part runs at any moment: a thread runs until it blocks in
+    one of the clock's waits, then hands over to the next thread that is ready, in the order
+    they became ready.  When no thread is ready, time jumps straight to the earliest deadline,
+    so sleeps, timeouts and polling intervals cost no real time.
+
+    The thread creating the clock takes part, as does every thread started with start_thread.
+    Other threads must not use the clock.
+    """
+    def __init__(self, start=SIMULATION_EPOCH):
+        self._now = float(start)
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._ready = collections.deque()
+        self._deadlocked = False
+
+    def time(self):
+        return self._now
+
+    def sleep(self, seconds):
+        self._block(lambda: False, max(0.0, seconds))
+
+    def event(self):
+        return VirtualEvent(self)
+
+    def semaphore(self, value):
+        return VirtualSemaphore(self, value)
+
+    def start_thread(self, target, *args):
+        thread = VirtualThread(self)
+        turn = {'deadline': None, 'result': True, 'running': False}
+
+        def run():
+            with self._cond:
+                self._wait_for_turn(turn)
+            try:
+                target(*args)
+            finally:
+                with self._cond:
+                    thread.done = True
+                    self._switch()
+
+        with self._cond:
+            self._ready.append(turn)
+        real_thread = threading.Thread(target=run)
+        real_thread.daemon = True
+        real_thread.start()
+        return thread
+
+    def _block(self, attempt, timeout=None):
+        """
+        Block the calling thread until attempt() returns True or the (virtual) timeout expires.
+        attempt is always called with the clock's lock held, so it may consume what it waits for.
+        :return: True if attempt() succeeded, False on timeout
+        """
+        with self._cond:
+            if attempt():
+                return True
+
+            turn = {'attempt': attempt, 'deadline': None, 'result': False, 'running': False}
+            if timeout is not None:
+                turn['deadline'] = self._now + timeout
+            self._waiting.append(turn)
+            self._switch()
+            self._wait_for_turn(turn)
+            return turn['result']
+
+    def _wait_for_turn(self, turn):
+        while not turn['running']:
+            if self._deadlocked:
+                raise SimulationDeadlock("Every simulated thread is waiting without a deadline")
+            self._cond.wait()
+
+    def _notify(self):
+        """
+        Move every waiting thread that can now proceed to the ready queue.  Must be called with
+        the lock held whenever something a thread may be waiting for changed.
+        """
+        for turn in list(self._waiting):
+            if turn['attempt']():
+                self._make_ready(turn, True)
+
+    def _make_ready(self, turn, result):
+        self._waiting.remove(turn)
+        turn['result'] = result
+        self._ready.append(turn)
+
+    def _switch(self):
+        """
+        Hand over from the running thread to the next ready thread, advancing time if none is ready.
+        """
+        self._notify()
+        while not self._ready:
+            deadlines = [turn['deadline'] for turn in self._waiting if turn['deadline'] is not None]
+            if not deadlines:
+                self._deadlocked = True
+                self._cond.notify_all()
+                return
+
+            self._now = max(self._now, min(deadlines))
+            for turn in list(self._waiting):
+                if turn['deadline'] is not None and turn['deadline'] <= self._now:
+                    self._make_ready(turn, turn['attempt']())
+
+        self._ready.popleft()['running'] = True
+        self._cond.notify_all()
+
+
+class VirtualEvent(object):
+    def __init__(self, clock):
+        self._clock = clock
+        self._flag = False
+
+    def is_set(self):
+        return self._flag
+
+    def set(self):
+        with self._clock._cond:
+            self._flag = True
+            self._clock._notify()
+
+    def clear(self):
+        with self._clock._cond:
+            self._flag = False
+
+    def wait(self, timeout=None):
+        return self._clock._block(lambda: self._flag, timeout)
+
+
+class VirtualSemaphore(object):
+    def __init__(self, clock, value):
+        self._clock = clock
+        self._value = value
+
+    def _try_acquire(self):
+        if self._value > 0:
+            self._value -= 1
+            return True
+        return False
+
+    def acquire(self):
+        return self._clock._block(self._try_acquire)
+
+    def release(self):
+        with self._clock._cond:
+            self._value += 1
+            self._clock._notify()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class VirtualThread(object):
+    def __init__(self, clock):
+        self._clock = clock
+        self.done = False
+
+    def is_alive(self):
+        return not self.done
+
+    def join(self, timeout=None):
+        self._clock._block(lambda: self.done, timeout)
+
+
+class SimulationConfig(object):
+    """
+    Shape of the simulated layer and how its instances and load balancer behave.
+    Durations are in (virtual) seconds; (low, high) tuples are sampled uniformly per instance.
+    """
+    def __init__(self, instances=10, zones=3, deploy_duration=(60, 120), failure_rate=0.0,
+                 elb=True, draining_timeout=300, healthy_threshold=2, health_interval=10,
+                 warmup=(0, 15), health_failure_rate=0.0, reboot_rate=0.0, reboot_duration=(60, 180), seed=0):
+        self.instances = instances
+        self.zones = zones
+        self.deploy_duration = deploy_duration
+        self.failure_rate = failure_rate
+        self.elb = elb
+        self.draining_timeout = draining_timeout
+        self.healthy_threshold = healthy_threshold
+        self.health_interval = health_interval
+        self.warmup = warmup
+        self.health_failure_rate = health_failure_rate
+        self.reboot_rate = reboot_rate
+        self.reboot_duration = reboot_duration
+        self.seed = seed
+
+
+class SimulatedCloud(object):
+    """
+    One stack with one layer (and optionally one load balancer) of online instances.
+    Stands in for easy_deploy's ClientPool: get_client returns fake OpsWorks, ELB and EC2
+    clients which record every call they receive.
+    """
+    STACK_ID = 'stack-1'
+    LAYER_ID = 'layer-1'
+    APP_ID = 'app-1'
+    STACK_NAME = 'simulated'
+    LAYER_NAME = 'app'
+    APP_NAME = 'myapp'
+    LOAD_BALANCER_NAME = 'simulated-elb'
+
+    def __init__(self, clock, config):
+        self.clock = clock
+        self.config = config
+        self.calls = collections.Counter()
+        self.min_in_service = None
+        self._lock = threading.Lock()
+
+        self.instances = collections.OrderedDict()
+        for index in range(config.instances):
+            instance_id = 'opsworks-{0:04d}'.format(index)
+            self.instances[instance_id] = {
+                'InstanceId': instance_id,
+                'Ec2InstanceId': 'i-{0:08x}'.format(index),
+                'Hostname': 'app{0}'.format(index + 1),
+                'Status': 'online',
+                'AvailabilityZone': 'us-east-1{0}'.format('abcdefgh'[index % config.zones]),
+                'PrivateIp': '10.0.{0}.{1}'.format(index // 250, index % 250 + 4),
+                'deployments': 0,
+                'deploying_until': None,
+                'rebooting_until': None,
+                'registered': config.elb,
+                'registered_at': float('-inf'),
+                'warm_at': float('-inf')
+            }
+        self._by_ec2_id = dict((each['Ec2InstanceId'], each) for each in self.instances.values())
+        self.deployments = {}
+        self.app_source = {'Type': 'git', 'Url': 'git://example.com/myapp.git', 'Revision': 'v1'}
+        self._record_in_service()
+
+        self._clients = {'opsworks': FakeOpsWorks(self), 'elb': FakeElasticLoadBalancing(self), 'ec2': FakeEC2(self)}
+
+    def get_client(self, service_name, region):
+        return CountingClient(self._clients[service_name], service_name, self.calls)
+
+    def _random(self, instance, name, attempt):
+        # seeded per instance, so results don't depend on the order threads make their calls in
+        return random.Random("{0}-{1}-{2}-{3}".format(self.config.seed, instance['InstanceId'], name, attempt))
+
+    def sample(self, instance, name, value_range, attempt=0):
+        """
+        :param value_range: fixed value or (low, high) tuple to sample uniformly from
+        """
+        if isinstance(value_range, (tuple, list)):
+            return self._random(instance, name, attempt).uniform(value_range[0], value_range[1])
+        return value_range
+
+    def chance(self, instance, name, probability, attempt=0):
+        return probability > 0 and self._random(instance, name, attempt).random() < probability
+
+    def is_deploying(self, instance):
+        return instance['deploying_until'] is not None and self.clock.time() < instance['deploying_until']
+
+    def is_rebooting(self, instance):
+        return not self.is_deploying(instance) and instance['rebooting_until'] is not None and self.clock.time() < instance['rebooting_until']
+
+    def status(self, instance):
+        return 'rebooting' if self.is_rebooting(instance) else instance['Status']
+
+    def is_in_service(self, instance):
+        """
+        An instance passes the health check once it has been registered and warmed up for long
+        enough to pass HealthyThreshold consecutive checks.  Without a load balancer every
+        instance that is not deploying counts as in service.
+        """
+        if self.is_deploying(instance) or self.is_rebooting(instance):
+            return False
+        if not self.config.elb:
+            return True
+        if not instance['registered']:
+            return False
+        passing_since = max(instance['registered_at'], instance['warm_at'])
+        return self.clock.time() >= passing_since + self.config.healthy_threshold * self.config.health_interval
+
+    def in_service_count(self):
+        return len([each for each in self.instances.values() if self.is_in_service(each)])
+
+    def _record_in_service(self):
+        in_service = self.in_service_count()
+        if self.min_in_service is None or in_service < self.min_in_service:
+            self.min_in_service = in_service
+
+    def finish_deployment(self, instance, completed_at, allow_reboot=False):
+        """
+        Set when the instance's application is warmed up after a deployment ending at completed_at,
+        which is after rebooting if the deployment is an update allowed to (and chosen to) reboot.
+        """
+        instance['rebooting_until'] = None
+        if allow_reboot and self.chance(instance, 'reboot', self.config.reboot_rate, instance['deployments']):
+            completed_at += self.sample(instance, 'reboot', self.config.reboot_duration, instance['deployments'])
+            instance['rebooting_until'] = completed_at
+        instance['warm_at'] = completed_at + self.sample(instance, 'warmup', self.config.warmup, instance['deployments'])
+        if self.chance(instance, 'health-failure', self.config.health_failure_rate, instance['deployments']):
+            instance['warm_at'] = float('inf')
+
+
+class CountingClient(object):
+    def __init__(self, client, service_name, calls):
+        self._client = client
+        self._service_name = service_name
+        self._calls = calls
+
+    def __getattr__(self, api_operation):
+        method = getattr(self._client, api_operation)
+
+        def call(**kwargs):
+            self._calls[(self._service_name, api_operation)] += 1
+            return method(**kwargs)
+        return call
+
+
+class FakeOpsWorks(object):
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def describe_stacks(self, **kwargs):
+        return {'Stacks': [{'StackId': self.cloud.STACK_ID, 'Name': self.cloud.STACK_NAME}]}
+
+    def describe_layers(self, **kwargs):
+        return {'Layers': [{'LayerId': self.cloud.LAYER_ID, 'Name': self.cloud.LAYER_NAME}]}
+
+    def describe_apps(self, **kwargs):
+        return {'Apps': [{'AppId': self.cloud.APP_ID, 'Shortname': self.cloud.APP_NAME, 'AppSource': self.cloud.app_source}]}
+
+    def describe_elastic_load_balancers(self, **kwargs):
+        if not self.cloud.config.elb:
+            return {'ElasticLoadBalancers': []}
+        return {'ElasticLoadBalancers': [{'ElasticLoadBalancerName': self.cloud.LOAD_BALANCER_NAME, 'LayerId': self.cloud.LAYER_ID}]}
+
+    def describe_instances(self, **kwargs):
+        instances = self.cloud.instances.values()
+        if 'InstanceIds' in kwargs:
+            instances = [each for each in instances if each['InstanceId'] in kwargs['InstanceIds']]
+        fields = ('InstanceId', 'Ec2InstanceId', 'Hostname', 'AvailabilityZone', 'PrivateIp')
+        return {'Instances': [dict([(field, each[field]) for field in fields], Status=self.cloud.status(each)) for each in instances]}
+
+    def create_deployment(self, **kwargs):
+        cloud = self.cloud
+        now = cloud.clock.time()
+        with cloud._lock:
+            deployment_id = 'deployment-{0:06d}'.format(len(cloud.deployments) + 1)
+            completed_at = now
+            failed_instance_ids = set()
+            custom_json = json.loads(kwargs.get('CustomJson') or '{}')
+            allow_reboot = (kwargs['Command']['Name'] == 'update_dependencies' and
+                            custom_json.get('dependencies', {}).get('allow_reboot', False))
+            for instance_id in kwargs['InstanceIds']:
+                instance = cloud.instances[instance_id]
+                duration = cloud.sample(instance, 'deploy', cloud.config.deploy_duration, instance['deployments'])
+                if cloud.chance(instance, 'deploy-failure', cloud.config.failure_rate, instance['deployments']):
+                    failed_instance_ids.add(instance_id)
+                cloud.finish_deployment(instance, now + duration, allow_reboot)
+                instance['deployments'] += 1
+                instance['deploying_until'] = now + duration
+                completed_at = max(completed_at, now + duration)
+
+            cloud.deployments[deployment_id] = {
+                'DeploymentId': deployment_id,
+                'StackId': kwargs['StackId'],
+                'AppId': kwargs.get('AppId'),
+                'Command': kwargs['Command'],
+                'InstanceIds': list(kwargs['InstanceIds']),
+                'CustomJson': kwargs.get('CustomJson'),
+                'created_at': now,
+                'completed_at': completed_at,
+                'failed_instance_ids': failed_instance_ids
+            }
+            cloud._record_in_service()
+        return {'DeploymentId': deployment_id}
+
+    def describe_deployments(self, **kwargs):
+        if 'AppId' in kwargs:
+            deployment_ids = [key for key, each in sorted(self.cloud.deployments.items()) if each['AppId'] == kwargs['AppId']]
+        else:
+            deployment_ids = kwargs.get('DeploymentIds', [])
+
+        now = self.cloud.clock.time()
+        deployments = []
+        for deployment_id in deployment_ids:
+            deployment = self.cloud.deployments[deployment_id]
+            result = dict((key, value) for key, value in deployment.items() if key[0].isupper())
+            result['CreatedAt'] = arrow.get(deployment['created_at']).isoformat()
+            if now >= deployment['completed_at']:
+                result['Status'] = 'failed' if deployment['failed_instance_ids'] else 'successful'
+                result['CompletedAt'] = arrow.get(deployment['completed_at']).isoformat()
+            else:
+                result['Status'] = 'running'
+            deployments.append(result)
+        return {'Deployments': deployments}
+
+    def describe_commands(self, **kwargs):
+        deployment = self.cloud.deployments[kwargs['DeploymentId']]
+        running = self.cloud.clock.time() < deployment['completed_at']
+        commands = []
+        for index, instance_id in enumerate(deployment['InstanceIds']):
+            status = 'failed' if instance_id in deployment['failed_instance_ids'] else 'successful'
+            commands.append({'CommandId': '{0}-{1}'.format(kwargs['DeploymentId'], index), 'DeploymentId': kwargs['DeploymentId'],
+                             'InstanceId': instance_id, 'Status': 'pending' if running else status})
+        return {'Commands': commands}
+
+
+class FakeElasticLoadBalancing(object):
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def describe_load_balancers(self, **kwargs):
+        return {'LoadBalancerDescriptions': [{
+            'LoadBalancerName': self.cloud.LOAD_BALANCER_NAME,
+            'Instances': [{'InstanceId': each['Ec2InstanceId']} for each in self.cloud.instances.values() if each['registered']],
+            'HealthCheck': {'HealthyThreshold': self.cloud.config.healthy_threshold, 'Interval': self.cloud.config.health_interval}
+        }]}
+
+    def describe_load_balancer_attributes(self, **kwargs):
+        timeout = self.cloud.config.draining_timeout
+        return {'LoadBalancerAttributes': {'ConnectionDraining': {'Enabled': bool(timeout), 'Timeout': timeout or 300}}}
+
+    def describe_instance_health(self, **kwargs):
+        cloud = self.cloud
+        if 'Instances' in kwargs:
+            instances = [cloud._by_ec2_id[each['InstanceId']] for each in kwargs['Instances']]
+        else:
+            instances = [each for each in cloud.instances.values() if each['registered']]
+
+        states = []
+        for each in instances:
+            state = {'InstanceId': each['Ec2InstanceId'], 'State': 'InService', 'ReasonCode': 'N/A', 'Description': 'N/A'}
+            if not each['registered']:
+                state.update(State='OutOfService', ReasonCode='ELB', Description='Instance is not currently registered with the LoadBalancer.')
+            elif not cloud.is_in_service(each):
+                state.update(State='OutOfService', ReasonCode='Instance',
+                             Description='Instance has failed at least the UnhealthyThreshold number of health checks consecutively.')
+            states.append(state)
+        return {'InstanceStates': states}
+
+    def deregister_instances_from_load_balancer(self, **kwargs):
+        cloud = self.cloud
+        with cloud._lock:
+            for each in kwargs['Instances']:
+                cloud._by_ec2_id[each['InstanceId']]['registered'] = False
+            cloud._record_in_service()
+            remaining = [{'InstanceId': each['Ec2InstanceId']} for each in cloud.instances.values() if each['registered']]
+        return {'Instances': remaining}
+
+    def register_instances_with_load_balancer(self, **kwargs):
+        cloud = self.cloud
+        with cloud._lock:
+            for each in kwargs['Instances']:
+                instance = cloud._by_ec2_id[each['InstanceId']]
+                instance['registered'] = True
+                instance['registered_at'] = cloud.clock.time()
+            registered = [{'InstanceId': each['Ec2InstanceId']} for each in cloud.instances.values() if each['registered']]
+        return {'Instances': registered}
+
+
+class FakeEC2(object):
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def describe_instance_status(self, **kwargs):
+        statuses = []
+        for each in kwargs['InstanceIds']:
+            instance = self.cloud._by_ec2_id[each]
+            check = 'initializing' if self.cloud.is_rebooting(instance) else 'ok'
+            statuses.append({'InstanceId': each, 'InstanceState': {'Name': 'running'},
+                             'InstanceStatus': {'Status': check}, 'SystemStatus': {'Status': check}})
+        return {'InstanceStatuses': statuses}
+
+
+class SimulationResult(object):
+    def __init__(self, strategy, config, duration, calls, min_in_service, outcome, log_lines, phases):
+        self.strategy = strategy
+        self.config = config
+        self.duration = duration
+        self.calls = calls
+        self.min_in_service = min_in_service
+        self.outcome = outcome
+        self.log_lines = log_lines
+        self.phases = phases
+
+    @property
+    def total_calls(self):
+        return sum(self.calls.values())
+
+
+# name -> (command, Operation method, keyword arguments)
+STRATEGIES = collections.OrderedDict([
+    ('rolling', ('deploy', 'layer_rolling', {})),
+    ('batch-10pct', ('deploy', 'layer_rolling', {'batch_percent': 10})),
+    ('pipeline', ('deploy', 'layer_rolling', {'pipeline': True, 'max_out_of_service': 2})),
+    ('all', ('deploy', 'layer_at_once', {})),
+    ('instances', ('deploy', 'instances_at_once', {})),
+    ('update-rolling', ('update', 'layer_rolling', {})),
+])
+
+
+def simulate(strategy, config, timeout=None):
+    """
+    Run one rollout strategy against a simulated layer.
+    :param strategy: key of STRATEGIES
+    :param config: SimulationConfig
+    :param timeout: deployment timeout passed to the operation
+    :return: SimulationResult
+    """
+    command, method, arguments = STRATEGIES[strategy]
+    clock = VirtualClock()
+    previous_clock = easy_deploy.CLOCK
+    previous_sink = getattr(easy_deploy.LOG_CONTEXT, 'sink', None)
+    easy_deploy.CLOCK = clock
+    # pollers, batchers and rate limiters hold events and threads of the previous clock
+    for each in vars(easy_deploy).values():
+        if isinstance(each, easy_deploy.MetadataCache):
+            each.clear()
+    easy_deploy.METRICS.clear()
+    random.seed(config.seed)
+
+    log_lines = []
+    easy_deploy.LOG_CONTEXT.sink = log_lines.append
+    cloud = SimulatedCloud(clock, config)
+    try:
+        context = click.Context(easy_deploy.cli, obj={'OPSWORKS_REGION': 'simulated', 'ELB_REGION': 'simulated'})
+        if command == 'update':
+            # updates reboot with probability config.reboot_rate
+            operation = easy_deploy.Update(context)
+            operation.allow_reboot = True
+        else:
+            operation = easy_deploy.Deploy(context)
+            operation.application_name = cloud.APP_NAME
+        operation.clients = cloud
+        operation.init(stack_name=cloud.STACK_NAME, layer_name=cloud.LAYER_NAME, timeout=timeout)
+
+        start_time = clock.time()
+        outcome = 'completed'
+        if method == 'instances_at_once':
+            arguments = dict(arguments, host_names=[each['Hostname'] for each in cloud.instances.values()])
+        try:
+            getattr(operation, method)(comment='simulated rollout', custom_json='{}', **arguments)
+        except SystemExit:
+            outcome = 'aborted'
+        duration = clock.time() - start_time
+    finally:
+        easy_deploy.CLOCK = previous_clock
+        easy_deploy.LOG_CONTEXT.sink = previous_sink
+
+    return SimulationResult(strategy, config, duration, cloud.calls, cloud.min_in_service, outcome, log_lines,
+                            easy_deploy.METRICS.phase_stats())
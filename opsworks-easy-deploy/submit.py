@@ -0,0 +1,74 @@
+#!/usr/bin/python
+
+#
+# Copyright 2014 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0
+#
+# or in the "license" file accompanying this file. This file is distributed
+# on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language governing
+# permissions and limitations under the License.
+#
+
+# Submits a job to a running `easy_deploy.py daemon` and streams its log.  Only uses the
+# standard library, so it starts much faster than easy_deploy.py itself.
+
+import os
+import sys
+import json
+import socket
+
+# same default as easy_deploy.DAEMON_SOCKET
+DEFAULT_SOCKET = os.path.join(os.path.expanduser('~'), '.easy_deploy', 'daemon.sock')
+
+
+def submit(socket_path, args):
+    """
+    Send the easy_deploy.py arguments to the daemon and print the job's log as it arrives.
+    :return: the job's exit code
+    """
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+    except socket.error as e:
+        sys.stderr.write("Cannot connect to the daemon on {0} ({1}), is `easy_deploy.py daemon` running?\n".format(socket_path, e))
+        return 1
+
+    try:
+        connection.sendall((json.dumps({'args': args}) + "\n").encode('utf-8'))
+        for line in connection.makefile('rb'):
+            message = json.loads(line.decode('utf-8'))
+            if 'log' in message:
+                sys.stdout.write(message['log'] + "\n")
+                sys.stdout.flush()
+            elif 'exit_code' in message:
+                return message['exit_code']
+    finally:
+        connection.close()
+
+    sys.stderr.write("The daemon closed the connection before the job finished\n")
+    return 1
+
+
+def main(args):
+    socket_path = DEFAULT_SOCKET
+    if args[:1] == ['--socket'] and len(args) > 1:
+        socket_path, args = args[1], args[2:]
+    elif args[:1] and args[0].startswith('--socket='):
+        socket_path, args = args[0].split('=', 1)[1], args[1:]
+
+    if not args or args[0] in ('-h', '--help'):
+        sys.stderr.write("Usage: submit.py [--socket PATH] <easy_deploy.py arguments>\n"
+                         "Runs easy_deploy.py arguments in the daemon listening on PATH (default: {0})\n".format(DEFAULT_SOCKET))
+        return 2
+
+    return submit(socket_path, args)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))